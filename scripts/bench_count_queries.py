@@ -0,0 +1,82 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# Time the queries count_occurances.py runs against one or more copies of cert_metadata, e.g. the
+#   original layout kept by migrate_cert_table.py --keep-old and the optimized one, and print the
+#   results as JSON.  Each query is run several times and the median taken
+import argparse
+import configparser
+import count_occurances
+import json
+import redshift_db
+import sys
+import time
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2 == 1:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+def time_query(function, repeat):
+    times = []
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        times.append(time.time() - start)
+    return result, { 'median_seconds': median(times), 'runs': times }
+
+def bench_table(db_conn, table, repeat):
+    queries = {}
+    dummy, queries['count_samples'] = time_query(
+        lambda: count_occurances.count_samples(db_conn, table), repeat)
+    bad_rows, queries['fetch_bad_rows'] = time_query(
+        lambda: count_occurances.fetch_bad_rows(db_conn, table), repeat)
+    field_counts = count_occurances.count_bad_values(bad_rows)
+    dummy, queries['count_total_values'] = time_query(
+        lambda: count_occurances.count_total_values(db_conn, field_counts, table), repeat)
+    total = 0.0
+    for name in queries:
+        total += queries[name]['median_seconds']
+    return { 'queries': queries, 'total_median_seconds': total, 'bad_rows': len(bad_rows) }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the count_occurances.py queries')
+    parser.add_argument('tables', nargs='+',
+                        help='tables to compare, e.g. cert_metadata_old cert_metadata')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to run each query (default: 3)')
+    parser.add_argument('--json', help='write the results here instead of stdout')
+    args = parser.parse_args()
+
+    settings = configparser.RawConfigParser()
+    settings.read('settings.ini')
+    db_conn = redshift_db.connect(settings)
+    server = redshift_db.fetch_one(db_conn, 'SELECT version()')[0]
+    # Otherwise every run after the first just comes back from Redshift's result cache
+    if 'Redshift' in server:
+        redshift_db.execute(db_conn, 'SET enable_result_cache_for_session TO off')
+        db_conn.commit()
+
+    results = { 'server': server, 'repeat': args.repeat, 'tables': {} }
+    for table in args.tables:
+        results['tables'][table] = bench_table(db_conn, table, args.repeat)
+        db_conn.commit()
+    baseline = results['tables'][args.tables[0]]['total_median_seconds']
+    for table in args.tables[1:]:
+        if results['tables'][table]['total_median_seconds'] > 0:
+            results['tables'][table]['speedup'] = (baseline /
+                                                   results['tables'][table]['total_median_seconds'])
+    db_conn.close()
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# Benchmark the stages of split_certs_redshift.py against a synthetic Project Sonar style file.
+#   'generate' writes a reproducible file of sha1,base64 DER lines and 'run' times each stage of
+#   the conversion on it, printing the results as JSON so runs can be compared across commits.
+import argparse
+import base64
+import datetime
+import functools
+import hashlib
+import io
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import split_certs_redshift
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+
+countries = [ 'US', 'GB', 'DE', 'CN', 'RU', 'BR', 'FR', 'NL' ]
+states = [ 'California', 'Texas', 'Some-State', 'Bavaria', 'Yorks', 'Beijing' ]
+localities = [ 'San Francisco', 'Austin', 'Munich', 'York', 'Moscow', 'Amsterdam' ]
+organizations = [ 'Acme Inc.', 'Internet Widgits Pty Ltd', 'Default Company Ltd',
+                  'Example Corp', 'Foo, Bar & Baz LLC', 'Unknown' ]
+units = [ 'IT', 'Operations', 'Domain Control Validated', 'Network Services' ]
+issuers = [ 'Example Root CA', 'Example Issuing CA 1', 'Example Issuing CA 2', 'Example DV CA' ]
+
+small_primes = [ 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79,
+                 83, 89, 97, 101, 103, 107, 109, 113, 127, 131, 137, 139, 149, 151, 157, 163, 167 ]
+
+# Miller-Rabin with a fixed number of rounds, fed from our seeded random source
+def is_probable_prime(n, rng):
+    if n < 4:
+        return n in (2, 3)
+    if n % 2 == 0:
+        return False
+    for prime in small_primes:
+        if n % prime == 0:
+            return n == prime
+    d = n - 1
+    r = 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    for i in range(16):
+        x = pow(rng.randrange(2, n - 1), d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for j in range(r - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def random_prime(bits, rng):
+    while True:
+        candidate = rng.getrandbits(bits) | (1 << (bits - 1)) | 1
+        if candidate % 65537 != 1 and is_probable_prime(candidate, rng):
+            return candidate
+
+# cryptography can't generate RSA keys from a seed, so build them from seeded primes instead
+def deterministic_rsa_key(bits, rng):
+    e = 65537
+    p = random_prime(bits // 2, rng)
+    q = random_prime(bits // 2, rng)
+    while q == p:
+        q = random_prime(bits // 2, rng)
+    d = pow(e, -1, (p - 1) * (q - 1))
+    public_numbers = rsa.RSAPublicNumbers(e, p * q)
+    private_numbers = rsa.RSAPrivateNumbers(p, q, d, rsa.rsa_crt_dmp1(d, p), rsa.rsa_crt_dmq1(d, q),
+                                            rsa.rsa_crt_iqmp(p, q), public_numbers)
+    return private_numbers.private_key(default_backend())
+
+def random_name(rng):
+    shape = rng.random()
+    attributes = []
+    if shape < 0.2:
+        # Just a common name, as many self-signed device certificates have
+        attributes.append(x509.NameAttribute(NameOID.COMMON_NAME, 'host%d.local' % rng.randrange(100000)))
+        return x509.Name(attributes)
+    attributes.append(x509.NameAttribute(NameOID.COUNTRY_NAME, rng.choice(countries)))
+    if shape < 0.7:
+        attributes.append(x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, rng.choice(states)))
+        attributes.append(x509.NameAttribute(NameOID.LOCALITY_NAME, rng.choice(localities)))
+    attributes.append(x509.NameAttribute(NameOID.ORGANIZATION_NAME, rng.choice(organizations)))
+    if shape < 0.5:
+        attributes.append(x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, rng.choice(units)))
+    attributes.append(x509.NameAttribute(NameOID.COMMON_NAME, 'www.example%d.com' % rng.randrange(100000)))
+    if shape > 0.85:
+        attributes.append(x509.NameAttribute(NameOID.EMAIL_ADDRESS, 'admin@example%d.com' % rng.randrange(1000)))
+    elif shape > 0.8:
+        attributes.append(x509.NameAttribute(NameOID.SERIAL_NUMBER, str(rng.randrange(10 ** 8))))
+    return x509.Name(attributes)
+
+# Write count synthetic certificates in the Sonar 'sha1,base64 DER' format.  Every certificate is
+#   signed with PKCS#1 v1.5 RSA, which unlike ECDSA is deterministic, so the same seed always
+#   produces the same file
+def generate_corpus(output_path, count, seed):
+    rng = random.Random(seed)
+    rsa_keys = [deterministic_rsa_key(bits, rng) for bits in (1024, 2048, 2048, 4096)]
+    ec_keys = [ec.derive_private_key(rng.getrandbits(200) + 1, curve(), default_backend())
+               for curve in (ec.SECP256R1, ec.SECP256R1, ec.SECP384R1)]
+    issuer_names = [x509.Name([x509.NameAttribute(NameOID.COUNTRY_NAME, 'US'),
+                               x509.NameAttribute(NameOID.ORGANIZATION_NAME, 'Example Trust'),
+                               x509.NameAttribute(NameOID.COMMON_NAME, name)]) for name in issuers]
+    epoch = datetime.datetime(1970, 1, 1)
+    with open(output_path, 'w') as output_file:
+        for i in range(count):
+            if rng.random() < 0.7:
+                subject_key = rng.choice(rsa_keys)
+            else:
+                subject_key = rng.choice(ec_keys)
+            subject = random_name(rng)
+            # Roughly a third are self-signed, the rest come from one of a few CAs
+            if rng.random() < 0.3:
+                issuer = subject
+            else:
+                issuer = rng.choice(issuer_names)
+            # Mostly ordinary validity periods, with some that run past 2049 and so are encoded
+            #   as GeneralizedTime rather than UTCTime
+            not_before = epoch + datetime.timedelta(seconds=rng.randrange(946684800, 1467331200))
+            if rng.random() < 0.1:
+                not_after = not_before + datetime.timedelta(days=rng.randrange(13000, 20000))
+            else:
+                not_after = not_before + datetime.timedelta(days=rng.choice([30, 90, 365, 730, 1095, 3650]))
+            builder = x509.CertificateBuilder().subject_name(subject).issuer_name(issuer)
+            builder = builder.public_key(subject_key.public_key())
+            builder = builder.serial_number(rng.getrandbits(rng.choice([32, 64, 128, 159])) + 1)
+            builder = builder.not_valid_before(not_before).not_valid_after(not_after)
+            signing_key = rsa_keys[i % len(rsa_keys)]
+            hash_algorithm = rng.choice([hashes.SHA256(), hashes.SHA256(), hashes.SHA384(), hashes.SHA512()])
+            cert = builder.sign(signing_key, hash_algorithm, default_backend())
+            cert_der = cert.public_bytes(serialization.Encoding.DER)
+            output_file.write(hashlib.sha1(cert_der).hexdigest() + ',' +
+                              base64.b64encode(cert_der).decode('ascii') + '\n')
+
+# Time a function over a list of inputs, returning the results and the stage's statistics
+def time_stage(function, items):
+    results = []
+    start = time.time()
+    for item in items:
+        results.append(function(item))
+    elapsed = time.time() - start
+    stats = { 'items': len(items), 'seconds': elapsed }
+    if elapsed > 0:
+        stats['per_second'] = len(items) / elapsed
+    return results, stats
+
+def git_commit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT)
+        return output.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(corpus_path, openssl_sample):
+    with open(corpus_path, 'r') as corpus_file:
+        lines = corpus_file.readlines()
+    stages = {}
+
+    encoded = [line.split(',')[1].strip() for line in lines]
+    ders, stages['base64_decode'] = time_stage(base64.b64decode, encoded)
+    records, stages['cert_decode'] = time_stage(split_certs_redshift.der_to_dict, ders)
+
+    # Forking openssl for every certificate is slow, so only a sample goes through that path.
+    #   Its output is also compared with the native decoder to catch any drift between the two
+    sample = ders[:openssl_sample]
+    texts = []
+    if len(sample) > 0:
+        start = time.time()
+        for cert_der in sample:
+            p = subprocess.Popen(['openssl', 'x509', '-inform', 'der', '-text', '-noout',
+                                  '-nameopt', 'compat'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            texts.append(p.communicate(input=cert_der)[0].decode('utf-8', 'replace'))
+        elapsed = time.time() - start
+        stages['openssl_fork'] = { 'items': len(sample), 'seconds': elapsed,
+                                   'per_second': len(sample) / elapsed }
+        openssl_records, stages['openssl_output_to_dict'] = time_stage(
+            split_certs_redshift.openssl_output_to_dict, texts)
+        mismatches = 0
+        for native, text in zip(records, openssl_records):
+            if native != text:
+                mismatches += 1
+        stages['openssl_output_to_dict']['parity_mismatches'] = mismatches
+
+    names = []
+    for record in records:
+        names.append(split_certs_redshift.unescape(record['enc_subject']))
+        names.append(split_certs_redshift.unescape(record['enc_issuer']))
+    dummy, stages['split_subfields'] = time_stage(split_certs_redshift.split_subfields, names)
+    # The same names parsed from scratch every time and through a fresh name cache, which is how
+    #   the converter actually sees them
+    dummy, stages['parse_name'] = time_stage(split_certs_redshift.parse_name, names)
+    name_cache = functools.lru_cache(maxsize=split_certs_redshift.name_cache_size)(
+        split_certs_redshift.parse_name)
+    dummy, stages['name_cache'] = time_stage(name_cache, names)
+    stages['name_cache']['hit_rate'] = float(name_cache.cache_info().hits) / max(len(names), 1)
+    times = []
+    for record in records:
+        times.append(record['not_valid_before_raw'].strip('\''))
+        times.append(record['not_valid_after_raw'].strip('\''))
+    dummy, stages['convert_time'] = time_stage(split_certs_redshift.convert_time, times)
+
+    for record, line, cert_der in zip(records, lines, ders):
+        record['sha1'] = line.split(',')[0]
+        record['date'] = '20160101'
+        record['size'] = len(cert_der)
+        record['feed_match'] = False
+    output = io.StringIO()
+    dummy, stages['print_csv'] = time_stage(lambda record: split_certs_redshift.print_csv(record, output),
+                                            records)
+
+    return { 'corpus': corpus_path,
+             'certs': len(lines),
+             'commit': git_commit(),
+             'python': platform.python_version(),
+             'native_decoder': split_certs_redshift.x509 is not None,
+             'stages': stages,
+             # ru_maxrss is in kilobytes on Linux
+             'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark split_certs_redshift.py')
+    subparsers = parser.add_subparsers(dest='command')
+    generate_parser = subparsers.add_parser('generate', help='write a synthetic Sonar file')
+    generate_parser.add_argument('output', help='file to write')
+    generate_parser.add_argument('--count', type=int, default=10000,
+                                 help='number of certificates (default: 10000)')
+    generate_parser.add_argument('--seed', type=int, default=2016,
+                                 help='random seed, the same seed always gives the same file')
+    run_parser = subparsers.add_parser('run', help='time each conversion stage')
+    run_parser.add_argument('corpus', help='Sonar format file, e.g. from generate')
+    run_parser.add_argument('--openssl-sample', type=int, default=200,
+                            help='certificates to run through openssl (default: 200)')
+    run_parser.add_argument('--json', help='write the results here instead of stdout')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate_corpus(args.output, args.count, args.seed)
+    elif args.command == 'run':
+        results = run_benchmark(args.corpus, args.openssl_sample)
+        if args.json:
+            with open(args.json, 'w') as json_file:
+                json.dump(results, json_file, indent=2, sort_keys=True)
+        else:
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# Shared handling for the SSLBL certificate blacklist feeds.
+
+# Every feed load_cert_feeds.py loads.  Each one is stored in S3 as <name>.csv, and the URL can be
+#   overridden in the [Feeds] section of settings.ini
+feeds = [ { 'name': 'sslbl',
+            'url': 'https://sslbl.abuse.ch/blacklist/sslblacklist.csv',
+            'description': 'abuse.ch SSL Fingerprint Blacklist',
+            'timeout': 30 },
+          { 'name': 'dyressl',
+            'url': 'https://sslbl.abuse.ch/blacklist/dyre_sslblacklist.csv',
+            'description': 'abuse.ch Dyre C2 SSL Fingerprint Blacklist',
+            'timeout': 60 } ]
+
+# Convert a feed as downloaded into the ts,sha1,reason,description rows we load into feed_certs
+def format_feed(response, description):
+    output = []
+    for line in response.splitlines():
+        if line.startswith('#'):
+            continue
+        fields = line.strip().split(',')
+        if len(fields) > 2:
+            output.append(fields[0] + ',' + fields[1] + ',' + fields[2] + ',' + description + '\n')
+    return ''.join(output)
+
+# Read the sha1s out of feed files, either as downloaded from abuse.ch or in the format
+#   load_cert_feeds.py uploads to S3.  Both have the sha1 as the second column
+def read_feed_sha1s(paths):
+    sha1s = set()
+    for path in paths:
+        with open(path, 'r') as feed_file:
+            for line in feed_file:
+                if line.startswith('#'):
+                    continue
+                fields = line.strip().split(',')
+                if len(fields) > 2:
+                    sha1s.add(fields[1].strip().lower())
+    return sha1s
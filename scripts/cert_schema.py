@@ -0,0 +1,122 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# The layout of the cert_metadata table, shared by redshift_load.py and migrate_cert_table.py.
+#   The columns have to stay in the same order as field_names in split_certs_redshift.py, since
+#   that's the order COPY loads them in
+import json
+
+# (column, type) for every column, as the table has always been created
+cert_columns = [ ('date', 'DATE'),
+                 ('sha1', 'CHAR(40)'),
+                 ('version', 'VARCHAR(16)'),
+                 ('serial_number', 'VARCHAR(255)'),
+                 ('subject', 'VARCHAR(8192)'),
+                 ('subject_c', 'VARCHAR(2048)'),
+                 ('subject_cn', 'VARCHAR(2048)'),
+                 ('subject_l', 'VARCHAR(2048)'),
+                 ('subject_o', 'VARCHAR(2048)'),
+                 ('subject_ou', 'VARCHAR(2048)'),
+                 ('subject_st', 'VARCHAR(2048)'),
+                 ('subject_emailaddress', 'VARCHAR(2048)'),
+                 ('subject_unstructuredname', 'VARCHAR(2048)'),
+                 ('subject_serialnumber', 'VARCHAR(2048)'),
+                 # Same data fields as above, but subject -> issuer
+                 ('issuer', 'VARCHAR(8192)'),
+                 ('issuer_c', 'VARCHAR(2048)'),
+                 ('issuer_cn', 'VARCHAR(2048)'),
+                 ('issuer_l', 'VARCHAR(2048)'),
+                 ('issuer_o', 'VARCHAR(2048)'),
+                 ('issuer_ou', 'VARCHAR(2048)'),
+                 ('issuer_st', 'VARCHAR(2048)'),
+                 ('issuer_emailaddress', 'VARCHAR(2048)'),
+                 ('issuer_unstructuredname', 'VARCHAR(2048)'),
+                 ('issuer_serialnumber', 'VARCHAR(2048)'),
+                 ('not_valid_before', 'TIMESTAMP'),
+                 ('not_valid_before_raw', 'VARCHAR(255)'),
+                 ('not_valid_after', 'TIMESTAMP'),
+                 ('not_valid_after_raw', 'VARCHAR(255)'),
+                 ('duration', 'BIGINT'),
+                 ('key_algorithm', 'VARCHAR(255)'),
+                 ('sig_algorithm', 'VARCHAR(255)'),
+                 ('key_type', 'VARCHAR(255)'),
+                 ('key_length', 'INT'),
+                 ('exponent', 'BIGINT'),
+                 ('curve', 'VARCHAR(255)'),
+                 ('size', 'INT'),
+                 ('self_signed', 'BOOLEAN'),
+                 ('feed_match', 'BOOLEAN') ]
+
+# Columns with only a handful of distinct values, which BYTEDICT stores as a one byte index into
+#   a per-block dictionary
+dictionary_columns = [ 'version', 'subject_c', 'issuer_c', 'key_algorithm', 'sig_algorithm',
+                       'key_type', 'key_length', 'curve' ]
+
+# count_occurances.py filters on feed_match and then on the subject fields, and loads come in by
+#   date.  A compound key only helps queries that filter on its leading columns, so the
+#   interleaved style gives the subject fields equal weight at the cost of slower vacuums
+sort_columns = [ 'feed_match', 'date', 'subject_o', 'subject_cn', 'subject_c', 'subject_ou' ]
+
+numeric_types = [ 'DATE', 'TIMESTAMP', 'BIGINT', 'INT' ]
+
+def varchar_length(column_type):
+    return int(column_type[8:-1])
+
+# Round an observed maximum length up to a VARCHAR size with some room to grow, never larger than
+#   the original column
+def varchar_size(max_length, original_size):
+    size = 16
+    while size < max_length * 1.5:
+        size *= 2
+    return min(size, original_size)
+
+def column_encoding(column, column_type, sort_style):
+    # Compressing the leading sort key column makes range restricted scans read more blocks
+    if sort_style == 'compound' and column == sort_columns[0]:
+        return 'RAW'
+    if column_type == 'BOOLEAN':
+        return 'RAW'
+    if column in dictionary_columns:
+        return 'BYTEDICT'
+    if column_type in numeric_types:
+        return 'AZ64'
+    return 'ZSTD'
+
+# The CREATE TABLE statement for the cert_metadata layout.  The original layout has no sort key
+#   or encodings.  The optimized one adds both, and sizes each VARCHAR from column_stats, a
+#   dictionary of column -> longest value in bytes, when it's given one
+def create_table_query(table, optimized=False, column_stats=None, sort_style='compound'):
+    columns = []
+    for column, column_type in cert_columns:
+        definition = column + ' ' + column_type
+        if optimized:
+            if column_type.startswith('VARCHAR(') and column_stats and column in column_stats:
+                original_size = varchar_length(column_type)
+                size = varchar_size(column_stats[column], original_size)
+                definition = column + ' VARCHAR(' + str(size) + ')'
+            definition += ' ENCODE ' + column_encoding(column, column_type, sort_style)
+        if column == 'sha1':
+            definition += ' DISTKEY'
+        columns.append(definition)
+    query = 'CREATE TABLE IF NOT EXISTS ' + table + '(' + ', '.join(columns) + ')'
+    if optimized:
+        query += ' ' + sort_style.upper() + ' SORTKEY (' + ', '.join(sort_columns) + ')'
+    return query
+
+# Whether any VARCHAR column in the sizes from the database is narrower than it was in the
+#   original layout, i.e. it was sized from column stats
+def narrowed(column_sizes):
+    for column, column_type in cert_columns:
+        if column_type.startswith('VARCHAR(') and column in column_sizes:
+            if column_sizes[column] < varchar_length(column_type):
+                return True
+    return False
+
+# The columns with values in column_stats too long for the sizes they have in the database
+def oversized_columns(column_sizes, column_stats):
+    return sorted([column for column in column_stats
+                   if column in column_sizes and column_stats[column] > column_sizes[column]])
+
+def read_column_stats(path):
+    with open(path, 'r') as stats_file:
+        return json.load(stats_file)
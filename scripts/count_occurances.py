@@ -1,24 +1,23 @@
 # Copyright (c) 2016, Atomic Mole LLC
 # All rights reserved.
 #
-# Load the SSLBL certificate feeds into an Amazon Resshift database via an S3 copy.  This creates
-#   the relevant table in Redshift if it does not already exist.
+# Look for subject field values that are common among certificates on the blacklist but rare
+#   everywhere else, and for other field values that tend to show up alongside them.
+import argparse
+import cert_feeds
 import configparser
-import psycopg2
-import pprint
-
-def redshift_connect(settings):
-    REDSHIFT_HOSTNAME = settings.get('Redshift', 'REDSHIFT_HOSTNAME')
-    REDSHIFT_DATABASE = settings.get('Redshift', 'REDSHIFT_DATABASE')
-    REDSHIFT_USER     = settings.get('Redshift', 'REDSHIFT_USER')
-    REDSHIFT_PASSWORD = settings.get('Redshift', 'REDSHIFT_PASSWORD')
-    
-    conn_string = 'dbname=\'' + REDSHIFT_DATABASE + '\' port=\'5439\' user=\'' + REDSHIFT_USER + '\''
-    conn_string += ' password=\'' + REDSHIFT_PASSWORD + '\'' + ' host=\'' + REDSHIFT_HOSTNAME + '\''
-    conn_string += ' connect_timeout=20 sslmode=require'
-    return psycopg2.connect(conn_string)
-    
-field_counts = {}
+import redshift_db
+
+# numpy and pyarrow are only needed to run the analysis locally against converter output
+try:
+    import numpy
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:
+    numpy = None
+
 field_names = [ 'subject_c',
                 'subject_cn',
                 'subject_l',
@@ -28,82 +27,230 @@ field_names = [ 'subject_c',
                 'subject_emailAddress',
                 'subject_unstructuredName',
                 'subject_serialNumber' ]
-                
-settings = configparser.RawConfigParser()
-settings.read('settings.ini')                
-
-db_conn = redshift_connect(settings)
-cursor = db_conn.cursor()
-
-# Figure out the ratio of our bad sample size to the total number of entries
-query = 'SELECT COUNT(*) from cert_metadata WHERE feed_match = True'
-cursor.execute(query)
-bad_samples = cursor.fetchone()[0]
-query = 'SELECT COUNT(*) from cert_metadata'
-cursor.execute(query)
-total_samples = cursor.fetchone()[0]
-
-print('Bad:   ' + str(bad_samples))
-print('Total: ' + str(total_samples))
-# I realize this ratio is kind of backwards, but it's a lot easier to read this way and look for 
-#   numbers closer to 1 
-print('Ratio: ' + str(float(total_samples)/bad_samples))
-
-for field in field_names:
-    query = 'SELECT ' + field + ', COUNT(*) FROM cert_metadata WHERE feed_match = True GROUP BY '
-    query += field + ' ORDER BY COUNT(*) DESC'
-    cursor.execute(query)
-    result = cursor.fetchall()
-    values = []
-    for row in result:
-        if row[1] > 1:
-            values.append((row[0], row[1]))
-    field_counts[field] = values
-    
-interesting_values = {}
-for field in field_counts:
-    interesting_values[field] = []
-    for value in field_counts[field]:
-            query = 'SELECT COUNT(*) FROM cert_metadata WHERE ' + field + ' = \'' + value[0] + '\'' 
-            cursor.execute(query)
-            result = cursor.fetchone()
+
+# Count how often each field value shows up in the blacklisted certificates, keeping only the
+#   values that show up more than once, most common first
+def count_bad_values(bad_rows):
+    field_counts = {}
+    for column_num in range(len(field_names)):
+        counts = {}
+        order = []
+        for row in bad_rows:
+            value = row[column_num]
+            if value == None:
+                continue
+            if value not in counts:
+                counts[value] = 0
+                order.append(value)
+            counts[value] += 1
+        values = [(value, counts[value]) for value in order if counts[value] > 1]
+        values.sort(key=lambda value: value[1], reverse=True)
+        field_counts[field_names[column_num]] = values
+    return field_counts
+
+# Count every candidate value across the whole table in a single pass, rather than one query per
+#   value.  Returns a dictionary of (field, value) -> count
+def count_total_values(db_conn, field_counts, table='cert_metadata'):
+    queries = []
+    params = []
+    for field in field_names:
+        if len(field_counts[field]) == 0:
+            continue
+        query = 'SELECT %s, ' + field + ', COUNT(*) FROM ' + table + ' WHERE '
+        query += field + ' IN (' + ', '.join(['%s'] * len(field_counts[field])) + ')'
+        query += ' GROUP BY ' + field
+        queries.append(query)
+        params += [field] + [value[0] for value in field_counts[field]]
+    totals = {}
+    if len(queries) == 0:
+        return totals
+    for row in redshift_db.stream(db_conn, ' UNION ALL '.join(queries), params):
+        totals[(row[0], row[1])] = row[2]
+    return totals
+
+# The number of blacklisted certificates and the number of certificates overall
+def count_samples(db_conn, table='cert_metadata'):
+    query = 'SELECT SUM(CASE WHEN feed_match = True THEN 1 ELSE 0 END), COUNT(*) FROM ' + table
+    return redshift_db.fetch_one(db_conn, query)
+
+# The blacklist is small, so pull every blacklisted row once and do the per-field and
+#   co-occurrence counting here instead of running a query for every value
+def fetch_bad_rows(db_conn, table='cert_metadata'):
+    query = 'SELECT ' + ', '.join(field_names) + ' FROM ' + table + ' WHERE feed_match = True'
+    return list(redshift_db.stream(db_conn, query))
+
+# Print and return the values that are much more common in the blacklist than overall
+def report_interesting(field_counts, totals):
+    interesting_values = {}
+    for field in field_names:
+        interesting_values[field] = []
+        for value in field_counts[field]:
+            total = totals.get((field, value[0]), 0)
             # If the only time this value was seen was in the blacklist there's really no way to 
             #   confirm a pattern. Ignore it for now, since blacklisting by hash seems effective
-            if result[0] > value[1]:
-                ratio = float(result[0]) / value[1]
+            if total > value[1]:
+                ratio = float(total) / value[1]
                 if ratio > 1.5:
-                    print(field + ': ' + value[0] + '     ' + str(value[1]) + ' -> ' + str(result[0]) + ' (' + str(ratio) + ')')
+                    print(field + ': ' + value[0] + '     ' + str(value[1]) + ' -> ' + str(total) + ' (' + str(ratio) + ')')
                     interesting_values[field].append(value)
+    return interesting_values
+
+# For each interesting value, count the other field values seen alongside it in the blacklist
+def report_cooccurrences(bad_rows, interesting_values):
+    for field in field_names:
+        field_num = field_names.index(field)
+        for value in interesting_values[field]:
+            values = {}
+            for column_name in field_names:
+                values[column_name] = {}
+            for row in bad_rows:
+                if row[field_num] != value[0]:
+                    continue
+                for column_num in range(len(field_names)):
+                    column_name = field_names[column_num]
+                    entry = row[column_num]
+                    if entry == None:
+                        continue
+                    if entry not in values[column_name]:
+                        values[column_name][entry] = 1
+                    else:
+                        values[column_name][entry] += 1
+            for column in field_names:
+                for entry in values[column]:
+                    if field != column and values[column][entry] > 1:
+                        print_cooccurrence(field, value[0], column, entry, values[column][entry])
+
+def print_cooccurrence(field, value, column, entry, count):
+    print(field + ': ' + value + ' + ' + column + ': ' + entry + '  ' + str(count))
+
+def print_ratio(bad_samples, total_samples):
+    print('Bad:   ' + str(bad_samples))
+    print('Total: ' + str(total_samples))
+    # I realize this ratio is kind of backwards, but it's a lot easier to read this way and look for 
+    #   numbers closer to 1 
+    print('Ratio: ' + str(float(total_samples)/bad_samples))
+
+# Name of the column split_certs_redshift.py writes for a field, e.g. subject_c -> enc_subject_C
+def converter_column(field):
+    suffix = field[8:]
+    if len(suffix) <= 2:
+        suffix = suffix.upper()
+    return 'enc_subject_' + suffix
 
-# Format all the fields we're going to request                
-field_list_string = ''
-for field in field_names:
-    if field_list_string == '':
-        field_list_string = field
+# Read the subject fields, sha1 and feed_match columns from files written by
+#   split_certs_redshift.py.  Text files are read with the same escaping rules COPY uses, so the
+#   values match what ends up in Redshift
+def read_local_table(paths):
+    names = [field.lower() for field in field_names] + ['sha1', 'feed_match']
+    tables = []
+    for path in paths:
+        if path.endswith('.parquet'):
+            table = pyarrow.parquet.read_table(path, columns=names)
+        else:
+            columns = [converter_column(field) for field in field_names] + ['sha1', 'feed_match']
+            column_types = dict((column, pyarrow.string()) for column in columns)
+            column_types['feed_match'] = pyarrow.bool_()
+            parse_options = pyarrow.csv.ParseOptions(delimiter='|', quote_char=False,
+                                                     escape_char='\\')
+            convert_options = pyarrow.csv.ConvertOptions(include_columns=columns,
+                                                         column_types=column_types)
+            table = pyarrow.csv.read_csv(path, parse_options=parse_options,
+                                         convert_options=convert_options)
+            table = table.rename_columns(names)
+        tables.append(table)
+    return pyarrow.concat_tables(tables)
+
+# Turn a column of strings into integer codes and the list of distinct values they refer to.
+#   Missing values get a code one past the end of the list
+def dictionary_encode(column):
+    encoded = pyarrow.compute.dictionary_encode(column.combine_chunks())
+    values = encoded.dictionary.to_pylist()
+    codes = pyarrow.compute.fill_null(encoded.indices, len(values))
+    return numpy.asarray(codes.to_numpy(zero_copy_only=False), dtype=numpy.int64), values
+
+# Return the codes in the order they first appear, along with how often each one appears
+def counts_in_order(codes, num_values):
+    counts = numpy.bincount(codes, minlength=num_values + 1)
+    distinct, first_seen = numpy.unique(codes, return_index=True)
+    order = distinct[numpy.argsort(first_seen, kind='stable')]
+    return [code for code in order if code < num_values], counts
+
+# The same report as the Redshift queries, computed from local files.  Each field is dictionary
+#   encoded so the counting is done with numpy over integer codes rather than per-row dictionaries
+def analyze_local(paths, feed_paths):
+    table = read_local_table(paths)
+    bad = numpy.asarray(table.column('feed_match').to_numpy(zero_copy_only=False), dtype=bool)
+    if feed_paths:
+        feed_sha1s = pyarrow.array(sorted(cert_feeds.read_feed_sha1s(feed_paths)), type=pyarrow.string())
+        in_feed = pyarrow.compute.is_in(table.column('sha1'), value_set=feed_sha1s)
+        bad |= numpy.asarray(in_feed.to_numpy(zero_copy_only=False), dtype=bool)
+    print_ratio(int(bad.sum()), table.num_rows)
+
+    encoded = {}
+    field_counts = {}
+    totals = {}
+    for field in field_names:
+        codes, values = dictionary_encode(table.column(field.lower()))
+        encoded[field] = (codes, values)
+        bad_order, bad_counts = counts_in_order(codes[bad], len(values))
+        total_counts = numpy.bincount(codes, minlength=len(values) + 1)
+        candidates = [code for code in bad_order if bad_counts[code] > 1]
+        candidates.sort(key=lambda code: bad_counts[code], reverse=True)
+        field_counts[field] = [(values[code], int(bad_counts[code])) for code in candidates]
+        for code in candidates:
+            totals[(field, values[code])] = int(total_counts[code])
+    interesting_values = report_interesting(field_counts, totals)
+
+    # Co-occurrences only involve blacklisted rows, so only look at those from here on
+    for field in field_names:
+        codes, values = encoded[field]
+        encoded[field] = (codes[bad], values)
+    for field in field_names:
+        codes, values = encoded[field]
+        value_codes = dict((values[code], code) for code in range(len(values)))
+        for value in interesting_values[field]:
+            rows = codes == value_codes[value[0]]
+            for column in field_names:
+                if column == field:
+                    continue
+                column_codes, column_values = encoded[column]
+                order, counts = counts_in_order(column_codes[rows], len(column_values))
+                for code in order:
+                    if counts[code] > 1:
+                        print_cooccurrence(field, value[0], column, column_values[code],
+                                           int(counts[code]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Look for field values that are common among '
+                                                 'blacklisted certificates')
+    parser.add_argument('--local', nargs='+', metavar='FILE',
+                        help='analyze files written by split_certs_redshift.py instead of '
+                             'querying Redshift (requires numpy and pyarrow)')
+    parser.add_argument('--feeds', nargs='+', metavar='FILE',
+                        help='with --local, also treat certificates in these feed files as '
+                             'blacklisted')
+    parser.add_argument('--table', default='cert_metadata',
+                        help='table to query in Redshift (default: cert_metadata)')
+    args = parser.parse_args()
+
+    if args.local:
+        if numpy is None:
+            parser.error('--local requires the numpy and pyarrow packages')
+        analyze_local(args.local, args.feeds)
     else:
-        field_list_string += ', ' + field
-        
-        
-for field in interesting_values:
-    for value in interesting_values[field]:
-        query = 'SELECT ' + field_list_string + ' FROM cert_metadata WHERE '
-        query += field + ' = \'' + value[0] + '\' and feed_match = True'
-        cursor.execute(query)
-        result = cursor.fetchall()
-        values = {}
-        for row in result:
-            for column_num in xrange(len(field_names)):
-                column_name = field_names[column_num]
-                if column_name not in values:
-                    values[column_name] = {}
-                if row[column_num] not in values[column_name]:
-                    values[column_name][row[column_num]] = 1
-                else:
-                    values[column_name][row[column_num]] += 1
-        for column in values:
-            for entry in values[column]:
-                if field != column and values[column][entry] > 1:
-                    print(field + ': ' + value[0] + ' + ' + column + ': ' + entry + '  ' + str(values[column][entry]))
-        #pprint.pprint(values)
-                
-db_conn.close()
+        settings = configparser.RawConfigParser()
+        settings.read('settings.ini')                
+
+        db_conn = redshift_db.connect(settings)
+
+        # Figure out the ratio of our bad sample size to the total number of entries
+        bad_samples, total_samples = count_samples(db_conn, args.table)
+        print_ratio(bad_samples, total_samples)
+
+        bad_rows = fetch_bad_rows(db_conn, args.table)
+        field_counts = count_bad_values(bad_rows)
+        totals = count_total_values(db_conn, field_counts, args.table)
+        interesting_values = report_interesting(field_counts, totals)
+        report_cooccurrences(bad_rows, interesting_values)
+
+        db_conn.close()
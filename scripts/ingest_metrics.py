@@ -0,0 +1,154 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# Counters and timers shared by the ingest scripts.  Each script keeps a Metrics object, prints
+#   progress lines and a summary to stderr, and can write its numbers out as JSON or as a
+#   Prometheus textfile for the node_exporter textfile collector.
+import contextlib
+import json
+import os
+import re
+import sys
+import time
+
+class Metrics(object):
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.counters = {}
+        # (name, label) -> seconds.  The label is '' for timers that aren't broken down further
+        self.timers = {}
+        # Largest value seen for each name, e.g. the longest value written to a column
+        self.maxima = {}
+        self.started = time.time()
+        self.last_progress = self.started
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def maximum(self, name, value):
+        if value > self.maxima.get(name, value - 1):
+            self.maxima[name] = value
+
+    def add_time(self, name, seconds, label=''):
+        key = (name, label)
+        self.timers[key] = self.timers.get(key, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, label=''):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start, label)
+
+    # A picklable copy of the numbers, so worker processes can hand theirs back to be merged
+    def snapshot(self):
+        return { 'counters': dict(self.counters),
+                 'maxima': dict(self.maxima),
+                 'timers': list((name, label, seconds) for (name, label), seconds in self.timers.items()) }
+
+    def merge(self, snapshot):
+        for name in snapshot['counters']:
+            self.count(name, snapshot['counters'][name])
+        for name in snapshot['maxima']:
+            self.maximum(name, snapshot['maxima'][name])
+        for name, label, seconds in snapshot['timers']:
+            self.add_time(name, seconds, label)
+
+    def reset(self):
+        self.counters = {}
+        self.timers = {}
+        self.maxima = {}
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def status_line(self, rate_counter):
+        elapsed = self.elapsed()
+        line = self.prefix + ': ' + ('%.0f' % elapsed) + 's'
+        for name in sorted(self.counters):
+            line += ', ' + name + '=' + str(self.counters[name])
+        if rate_counter in self.counters and elapsed > 0:
+            line += ', ' + rate_counter + '/sec=' + ('%.1f' % (self.counters[rate_counter] / elapsed))
+        return line
+
+    # Print a status line if at least interval seconds have passed since the last one
+    def progress(self, interval, rate_counter):
+        now = time.time()
+        if interval and now - self.last_progress >= interval:
+            self.last_progress = now
+            sys.stderr.write(self.status_line(rate_counter) + '\n')
+            sys.stderr.flush()
+
+    def summary(self, rate_counter=None):
+        sys.stderr.write(self.status_line(rate_counter) + '\n')
+        for name, label in sorted(self.timers):
+            description = name
+            if label:
+                description += ' ' + label
+            sys.stderr.write('  ' + description + ': ' + ('%.3f' % self.timers[(name, label)]) + 's\n')
+        sys.stderr.flush()
+
+    def to_dict(self):
+        timers = {}
+        for (name, label), seconds in self.timers.items():
+            if label:
+                timers.setdefault(name, {})[label] = seconds
+            else:
+                timers[name] = seconds
+        return { 'prefix': self.prefix,
+                 'elapsed_seconds': self.elapsed(),
+                 'counters': self.counters,
+                 'maxima': self.maxima,
+                 'timers': timers }
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.to_dict(), indent=2, sort_keys=True) + '\n')
+
+    def write_prometheus(self, path):
+        lines = []
+        name = metric_name(self.prefix + '_elapsed_seconds')
+        lines.append('# TYPE ' + name + ' gauge')
+        lines.append(name + ' ' + repr(self.elapsed()))
+        for counter in sorted(self.counters):
+            name = metric_name(self.prefix + '_' + counter + '_total')
+            lines.append('# TYPE ' + name + ' counter')
+            lines.append(name + ' ' + str(self.counters[counter]))
+        for maximum in sorted(self.maxima):
+            name = metric_name(self.prefix + '_' + maximum)
+            lines.append('# TYPE ' + name + ' gauge')
+            lines.append(name + ' ' + str(self.maxima[maximum]))
+        typed = set()
+        for timer, label in sorted(self.timers):
+            name = metric_name(self.prefix + '_' + timer + '_seconds')
+            if name not in typed:
+                lines.append('# TYPE ' + name + ' gauge')
+                typed.add(name)
+            if label:
+                escaped = label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                name += '{source="' + escaped + '"}'
+            lines.append(name + ' ' + repr(self.timers[(timer, label)]))
+        write_atomically(path, '\n'.join(lines) + '\n')
+
+    # Write whichever outputs were asked for on the command line
+    def write_outputs(self, json_path, prometheus_path):
+        if json_path:
+            self.write_json(json_path)
+        if prometheus_path:
+            self.write_prometheus(prometheus_path)
+
+def metric_name(name):
+    return re.sub('[^a-zA-Z0-9_]', '_', name)
+
+# The textfile collector may read the file at any time, so never let it see a partial one
+def write_atomically(path, contents):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as output_file:
+        output_file.write(contents)
+    os.rename(temp_path, path)
+
+def add_arguments(parser):
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help='write counters and timings to this file as JSON')
+    parser.add_argument('--metrics-prom', metavar='PATH',
+                        help='write counters and timings to this file in the Prometheus text format')
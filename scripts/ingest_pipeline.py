@@ -0,0 +1,294 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# Convert, upload and load one or more Sonar snapshots in a single run, with the three stages
+#   overlapping instead of each waiting for the one before to finish on everything.
+#   split_certs_redshift.py --shard-rows writes the output as a series of files and prints each one
+#   as it's finished; each file is uploaded to S3 as soon as it's announced, and the uploaded files
+#   are COPYed into Redshift in manifest sized groups while later ones are still being converted.
+#   The stages hand files on through bounded asyncio queues, so a slow stage holds back the ones
+#   before it rather than letting work pile up, and uploaded files are removed straight away, so
+#   the disk only ever holds a few of them.  The whole run should take about as long as its
+#   slowest stage.
+#
+# Other split_certs_redshift.py options, e.g. --workers, --feeds or --delta-index, can be passed
+#   to it with --split-args.  The S3_ENDPOINT_URL, REDSHIFT_PORT and REDSHIFT_SSLMODE settings can
+#   point the uploads and the database connection at local stand-ins for S3 and Redshift.  With
+#   --delta-index, split_certs_redshift.py updates a staged copy of the index, which only replaces
+#   the real one once everything is committed, so a failed run can just be run again
+import argparse
+import asyncio
+import cert_schema
+import concurrent.futures
+import configparser
+import ingest_metrics
+import os
+import redshift_db
+import redshift_load
+import shlex
+import shutil
+import split_certs_redshift
+import sys
+import time
+
+split_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'split_certs_redshift.py')
+
+# Run split_certs_redshift.py over each snapshot in turn, queueing every file it finishes.  While
+#   the upload queue is full we stop reading its output, and it waits to start a new file while
+#   there are more than max_pending of its files still on disk
+async def convert(cert_files, split_args, upload_queue, metrics):
+    for cert_file in cert_files:
+        start = time.time()
+        command = [sys.executable, split_script, cert_file] + split_args
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if len(line) == 0:
+                    break
+                line = line.decode('utf-8', 'replace')
+                if line.startswith(split_certs_redshift.shard_ready_prefix):
+                    metrics.count('files_converted')
+                    path = line[len(split_certs_redshift.shard_ready_prefix):].rstrip('\n')
+                    await upload_queue.put(path)
+                else:
+                    sys.stdout.write(line)
+            if await process.wait() != 0:
+                raise RuntimeError('split_certs_redshift.py failed on ' + cert_file)
+        finally:
+            if process.returncode == None:
+                process.kill()
+                await process.wait()
+        metrics.add_time('convert', time.time() - start, cert_file)
+
+# Upload each file to S3 and pass its URI on to be loaded.  boto3 blocks, so the uploads run in
+#   the default thread pool, one per upload task
+async def upload(s3, bucket_name, key_prefix, keep_local, upload_queue, copy_queue, metrics):
+    loop = asyncio.get_running_loop()
+    while True:
+        path = await upload_queue.get()
+        if path == None:
+            break
+        key = key_prefix + os.path.basename(path)
+        size = os.path.getsize(path)
+        start = time.time()
+        await loop.run_in_executor(None, s3.upload_file, path, bucket_name, key)
+        metrics.add_time('upload', time.time() - start)
+        metrics.count('files_uploaded')
+        metrics.count('bytes_uploaded', size)
+        if not keep_local:
+            os.remove(path)
+        await copy_queue.put({ 'url': 's3://' + bucket_name + '/' + key,
+                               'mandatory': True,
+                               'meta': { 'content_length': size } })
+
+# The number of slices in the cluster, or 1 if we're not talking to Redshift
+def cluster_slices(db_conn):
+    if 'Redshift' not in redshift_db.fetch_one(db_conn, 'SELECT version()')[0]:
+        return 1
+    return redshift_db.fetch_one(db_conn, 'SELECT COUNT(*) FROM stv_slices')[0]
+
+# Wait for the next uploaded file, then take whatever else is already waiting, up to group_size
+#   files.  Returns the manifest entries and whether the uploads have finished
+async def next_group(copy_queue, group_size):
+    entries = []
+    entry = await copy_queue.get()
+    while entry != None:
+        entries.append(entry)
+        if len(entries) >= group_size or copy_queue.empty():
+            return entries, False
+        entry = copy_queue.get_nowait()
+    return entries, True
+
+# COPY the uploaded files a group at a time.  A COPY of a single file is loaded by a single slice,
+#   so, as with redshift_load.py, each group is listed in a manifest and loaded with one COPY that
+#   Redshift spreads across its slices.  When COPYs are keeping up, groups are whatever has arrived
+#   since the last one; when they fall behind the groups grow, up to group_size files.  The
+#   connection is only ever used from the one thread, and everything is committed together once
+#   the last file is in, so a failed run leaves the tables as they were
+async def load(db_conn, settings, s3, bucket_name, key_prefix, group_size, truncate, copy_queue,
+               metrics):
+    loop = asyncio.get_running_loop()
+    db_thread = concurrent.futures.ThreadPoolExecutor(1)
+    manifests = 0
+    try:
+        finished = False
+        while not finished:
+            entries, finished = await next_group(copy_queue, group_size)
+            # Every file in a COPY has to be in the same format, e.g. the .gone file at the end
+            formats = {}
+            for entry in entries:
+                formats.setdefault(redshift_load.file_format(entry['url']), []).append(entry)
+            for data_format in formats:
+                key = key_prefix + 'manifests/copy%04d.manifest' % manifests
+                manifests += 1
+                manifest_uri = await loop.run_in_executor(None, redshift_load.upload_manifest, s3,
+                                                          bucket_name, key, formats[data_format])
+                start = time.time()
+                await loop.run_in_executor(db_thread, redshift_load.load_file_from_s3,
+                                           manifest_uri, db_conn, settings, data_format, True,
+                                           truncate)
+                metrics.add_time('copy', time.time() - start)
+                metrics.count('copies')
+                metrics.count('files_loaded', len(formats[data_format]))
+        start = time.time()
+        await loop.run_in_executor(db_thread, db_conn.commit)
+        metrics.add_time('commit', time.time() - start)
+    finally:
+        db_thread.shutdown()
+
+# The --delta-index path in the split_certs_redshift.py options, if there is one
+def delta_index_path(split_args):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--delta-index')
+    return parser.parse_known_args(split_args)[0].delta_index
+
+# split_certs_redshift.py brings the delta index and its .seen index up to date as soon as it's
+#   through a snapshot, long before the rows it wrote are committed.  If the run then failed, a
+#   retry would find the index already up to date, and the next snapshot would skip the new
+#   certificates that never made it in.  So it's given a staged copy of both to update instead.
+#   The index files are only ever replaced, never written in place, so a link to each will do
+def stage_delta_index(index_path):
+    discard_delta_index(index_path)
+    staged_path = index_path + '.pending'
+    for suffix in ['', '.seen']:
+        if os.path.exists(index_path + suffix):
+            try:
+                os.link(index_path + suffix, staged_path + suffix)
+            except OSError:
+                shutil.copyfile(index_path + suffix, staged_path + suffix)
+    return staged_path
+
+# Once everything is committed, move the staged indexes over the real ones.  The .seen index goes
+#   first, so being stopped in between leaves certificates marked as seen, which are in the
+#   database now, rather than new certificates that would be loaded a second time
+def commit_delta_index(index_path):
+    staged_path = index_path + '.pending'
+    for suffix in ['.seen', '']:
+        if os.path.exists(staged_path + suffix):
+            os.replace(staged_path + suffix, index_path + suffix)
+
+def discard_delta_index(index_path):
+    staged_path = index_path + '.pending'
+    for suffix in ['', '.seen']:
+        if os.path.exists(staged_path + suffix):
+            os.remove(staged_path + suffix)
+
+# Once a stage is done, tell each task of the next stage to stop
+async def finish_stage(tasks, next_queue, next_tasks):
+    await asyncio.gather(*tasks)
+    for dummy in range(next_tasks):
+        await next_queue.put(None)
+
+async def run_pipeline(args, split_args, settings, metrics):
+    s3 = redshift_load.s3_client(settings)
+    bucket_name = settings.get('S3', 'S3_BUCKET_NAME')
+    db_conn = redshift_db.connect(settings)
+    group_size = args.files_per_copy
+    if group_size == 0:
+        group_size = cluster_slices(db_conn)
+    upload_queue = asyncio.Queue(args.queue_size)
+    # Uploaded files are already off the disk, so there's room for a whole group to build up
+    copy_queue = asyncio.Queue(max(args.queue_size, group_size))
+    column_stats = None
+    if args.column_stats:
+        column_stats = cert_schema.read_column_stats(args.column_stats)
+    redshift_load.create_cert_table(db_conn, args.schema == 'optimized', column_stats,
+                                    args.sort_style)
+    truncate = redshift_load.check_column_sizes(db_conn, column_stats)
+    db_conn.commit()
+
+    converter = asyncio.ensure_future(convert(args.cert_files, split_args, upload_queue, metrics))
+    uploaders = [asyncio.ensure_future(upload(s3, bucket_name, args.key_prefix, args.keep_local,
+                                              upload_queue, copy_queue, metrics))
+                 for dummy in range(args.upload_workers)]
+    loader = asyncio.ensure_future(load(db_conn, settings, s3, bucket_name, args.key_prefix,
+                                        group_size, truncate, copy_queue, metrics))
+    tasks = [converter, loader] + uploaders
+    stages = [asyncio.ensure_future(finish_stage([converter], upload_queue, len(uploaders))),
+              asyncio.ensure_future(finish_stage(uploaders, copy_queue, 1)),
+              loader]
+    try:
+        # Stop everything as soon as any stage fails, rather than waiting on a queue nobody is
+        #   going to fill or empty
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() != None:
+                raise task.exception()
+        await asyncio.gather(*stages)
+    finally:
+        for task in tasks + stages:
+            task.cancel()
+        await asyncio.gather(*(tasks + stages), return_exceptions=True)
+        # Closing without a commit throws away anything loaded before a failure
+        db_conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert Sonar certificate files and load them '
+                                                 'into Redshift with the stages overlapped')
+    parser.add_argument('cert_files', nargs='+', metavar='cert_file',
+                        help='Project Sonar certificate files, optionally gzipped')
+    parser.add_argument('--shard-rows', type=int, default=1000000,
+                        help='rows in each file uploaded and loaded (default: 1000000)')
+    parser.add_argument('--compress', choices=sorted(split_certs_redshift.output_extensions),
+                        default='gzip', help='compression for the files (default: gzip)')
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help='files waiting for each of the upload and load stages before the '
+                             'stage before it waits too (default: 4)')
+    parser.add_argument('--files-per-copy', type=int, default=0, metavar='N',
+                        help='most files to load with each COPY, ideally a multiple of the '
+                             'cluster\'s slices (default: the number of slices)')
+    parser.add_argument('--upload-workers', type=int, default=2,
+                        help='files to upload at once (default: 2)')
+    parser.add_argument('--key-prefix', default='pipeline/',
+                        help='prefix for the S3 keys the files are uploaded to '
+                             '(default: pipeline/)')
+    parser.add_argument('--keep-local', action='store_true',
+                        help='keep the converted files once they\'re uploaded.  The disk space '
+                             'they take up is then no longer bounded')
+    parser.add_argument('--schema', choices=['original', 'optimized'], default='original',
+                        help='layout for cert_metadata if it doesn\'t exist yet, as for '
+                             'redshift_load.py (default: original)')
+    parser.add_argument('--column-stats', metavar='FILE',
+                        help='with --schema optimized, size the VARCHAR columns from this file, '
+                             'as for redshift_load.py')
+    parser.add_argument('--sort-style', choices=['compound', 'interleaved'], default='compound',
+                        help='sort key style for --schema optimized (default: compound)')
+    parser.add_argument('--split-args', default='',
+                        help='more options for split_certs_redshift.py, as one quoted string, '
+                             'e.g. --split-args="--workers 4 --feeds sslbl.csv"')
+    ingest_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.files_per_copy < 0:
+        parser.error('--files-per-copy can\'t be negative')
+    if args.shard_rows < 1 or args.queue_size < 1 or args.upload_workers < 1:
+        parser.error('--shard-rows, --queue-size and --upload-workers must be at least 1')
+
+    split_args = shlex.split(args.split_args)
+    split_args += ['--shard-rows', str(args.shard_rows), '--compress', args.compress]
+    # The last --delta-index given is the one split_certs_redshift.py uses
+    delta_index = delta_index_path(split_args)
+    if delta_index:
+        split_args += ['--delta-index', stage_delta_index(delta_index)]
+    if not args.keep_local:
+        # Files are removed as soon as they're uploaded, so the ones on disk are those waiting in
+        #   the upload queue or being uploaded
+        max_pending = args.queue_size + args.upload_workers
+        split_args += ['--max-pending-shards', str(max_pending)]
+
+    settings = configparser.RawConfigParser()
+    settings.read('settings.ini')
+    metrics = ingest_metrics.Metrics('ingest_pipeline')
+    try:
+        asyncio.run(run_pipeline(args, split_args, settings, metrics))
+        if delta_index:
+            commit_delta_index(delta_index)
+    finally:
+        # After a failure the real index is still where it was, ready for the run to be retried
+        if delta_index:
+            discard_delta_index(delta_index)
+    metrics.summary()
+    metrics.write_outputs(args.metrics_json, args.metrics_prom)
+
+if __name__ == '__main__':
+    main()
@@ -3,94 +3,169 @@
 #
 # Load the SSLBL certificate feeds into an Amazon Resshift database via an S3 copy.  This creates
 #   the relevant table in Redshift if it does not already exist.
-import boto3
+import argparse
+import botocore.exceptions
+import cert_feeds
+import concurrent.futures
 import configparser
 import datetime
-import psycopg2
-import urllib2
-
-def download_sslbl(bucket_name):
-    s3 = boto3.resource('s3')
-    req = urllib2.urlopen('https://sslbl.abuse.ch/blacklist/sslblacklist.csv', timeout=30)
-    response = req.read()
-    output = ''
-    ignore = True
-    for line in response.splitlines():
-        if line.startswith('#'):
-            continue
-        fields = line.strip().split(',')
-        if len(fields) > 2:
-            record_time = datetime.datetime.strptime(fields[0], '%Y-%m-%d %H:%M:%S')
-            output += fields[0] + ',' + fields[1] + ',' + fields[2] + ',abuse.ch SSL Fingerprint Blacklist\n'
-    s3_filename = 'sslbl.csv'
-    s3.Object(bucket_name, s3_filename).put(Body=output.encode())
-    return 's3://' + bucket_name + '/' + s3_filename
-    
-def download_dyressl(bucket_name):
-    s3 = boto3.resource('s3')
-    req = urllib2.urlopen('https://sslbl.abuse.ch/blacklist/dyre_sslblacklist.csv', timeout=60)
-    response = req.read()
-    output = ''
-    ignore = True
-    for line in response.splitlines():
-        if line.startswith('#'):
-            continue
-        fields = line.strip().split(',')
-        if len(fields) > 2:
-            record_time = datetime.datetime.strptime(fields[0], '%Y-%m-%d %H:%M:%S')
-            output += fields[0] + ',' + fields[1] + ',' + fields[2] + ',abuse.ch Dyre C2 SSL Fingerprint Blacklist\n'
-    s3_filename = 'dyressl.csv'
-    s3.Object(bucket_name, s3_filename).put(Body=output.encode())
-    return 's3://' + bucket_name + '/' + s3_filename
-
-def redshift_connect(settings):
-    REDSHIFT_HOSTNAME = settings.get('Redshift', 'REDSHIFT_HOSTNAME')
-    REDSHIFT_DATABASE = settings.get('Redshift', 'REDSHIFT_DATABASE')
-    REDSHIFT_USER     = settings.get('Redshift', 'REDSHIFT_USER')
-    REDSHIFT_PASSWORD = settings.get('Redshift', 'REDSHIFT_PASSWORD')
-    
-    conn_string = 'dbname=\'' + REDSHIFT_DATABASE + '\' port=\'5439\' user=\'' + REDSHIFT_USER + '\''
-    conn_string += ' password=\'' + REDSHIFT_PASSWORD + '\'' + ' host=\'' + REDSHIFT_HOSTNAME + '\''
-    conn_string += ' connect_timeout=20 sslmode=require'
-    return psycopg2.connect(conn_string)
+import ingest_metrics
+import redshift_db
+import redshift_load
+import sys
+# urllib3 comes along with boto3, and unlike urllib2 it keeps connections open between requests
+import urllib3
+
+# Download a feed and store it in S3, unless it hasn't changed since we last stored it.  The
+#   ETag and Last-Modified headers from the last download are kept as metadata on the S3 object,
+#   so we can ask the server for the feed only if it's changed.  Returns the feed's S3 URI, whether
+#   it changed, and the ETag of the S3 object, which is what tells us whether it's been loaded
+def download_feed(feed, http, s3, bucket_name, settings, metrics):
+    url = feed['url']
+    if settings.has_option('Feeds', feed['name']):
+        url = settings.get('Feeds', feed['name'])
+    s3_filename = feed['name'] + '.csv'
+    s3_uri = 's3://' + bucket_name + '/' + s3_filename
+
+    headers = {}
+    s3_etag = None
+    try:
+        s3_object = s3.head_object(Bucket=bucket_name, Key=s3_filename)
+        s3_etag = s3_object['ETag']
+        metadata = s3_object['Metadata']
+        if 'source-etag' in metadata:
+            headers['If-None-Match'] = metadata['source-etag']
+        if 'source-last-modified' in metadata:
+            headers['If-Modified-Since'] = metadata['source-last-modified']
+    except botocore.exceptions.ClientError:
+        pass
+
+    with metrics.timer('download', feed['name']):
+        response = http.request('GET', url, headers=headers, timeout=feed['timeout'])
+    if response.status == 304:
+        print(url + ' unchanged')
+        metrics.count('feeds_unchanged')
+        return s3_uri, False, s3_etag
+    elif response.status != 200:
+        raise RuntimeError(url + ' returned HTTP ' + str(response.status))
+
+    output = cert_feeds.format_feed(response.data.decode('utf-8', 'replace'), feed['description'])
+    metadata = {}
+    if response.headers.get('ETag'):
+        metadata['source-etag'] = response.headers.get('ETag')
+    if response.headers.get('Last-Modified'):
+        metadata['source-last-modified'] = response.headers.get('Last-Modified')
+    s3_object = s3.put_object(Bucket=bucket_name, Key=s3_filename, Body=output.encode(),
+                              Metadata=metadata)
+    print(url + ' downloaded')
+    metrics.count('feeds_changed')
+    metrics.count('bytes_downloaded', len(response.data))
+    return s3_uri, True, s3_object['ETag']
+
+# Fetch every feed at once over a shared pool of HTTP connections
+def download_feeds(bucket_name, settings, metrics):
+    http = urllib3.PoolManager()
+    s3 = redshift_load.s3_client(settings)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(cert_feeds.feeds)) as executor:
+        futures = [executor.submit(download_feed, feed, http, s3, bucket_name, settings, metrics)
+                   for feed in cert_feeds.feeds]
+        return [future.result() for future in futures]
+
+# The S3 ETag of each feed file as of the last successful load.  It's kept in Redshift and updated
+#   in the same transaction as the load, so a load that fails is tried again on the next run even
+#   though the feeds themselves won't have changed by then
+def loaded_etags(db_conn):
+    query = 'CREATE TABLE IF NOT EXISTS feed_loads (s3_uri VARCHAR(1024), etag VARCHAR(256))'
+    redshift_db.execute(db_conn, query)
+    cursor = redshift_db.execute(db_conn, 'SELECT s3_uri, etag FROM feed_loads')
+    etags = dict(cursor.fetchall())
+    cursor.close()
+    return etags
+
+def record_loaded_etags(db_conn, downloads):
+    redshift_db.execute(db_conn, 'DELETE FROM feed_loads')
+    for s3_uri, changed, s3_etag in downloads:
+        redshift_db.execute(db_conn, 'INSERT INTO feed_loads VALUES (%s, %s)', (s3_uri, s3_etag))
 
 def load_file_from_s3(s3_uri, db_conn, settings):
-    COPY_AWS_ACCESS_KEY_ID = settings.get('Copy', 'COPY_AWS_ACCESS_KEY_ID')
-    COPY_AWS_SECRET_KEY    = settings.get('Copy', 'COPY_AWS_SECRET_KEY')
-    
-    cursor = db_conn.cursor()
-    copy_query = 'COPY feed_certs_new FROM \'' + s3_uri + '\''
-    copy_query += ' credentials \'aws_access_key_id=' + COPY_AWS_ACCESS_KEY_ID
-    copy_query += ';aws_secret_access_key=' + COPY_AWS_SECRET_KEY + '\''
+    copy_query = 'COPY feed_certs_new FROM %s credentials %s'
     copy_query += ' delimiter \',\' DATEFORMAT \'auto\''
-    cursor.execute(copy_query)
+    redshift_db.execute(db_conn, copy_query, (s3_uri, redshift_db.copy_credentials(settings)))
     print(s3_uri + ' loaded')
 
+parser = argparse.ArgumentParser(description='Download the blacklist feeds and load them into '
+                                             'Redshift')
+ingest_metrics.add_arguments(parser)
+args = parser.parse_args()
+metrics = ingest_metrics.Metrics('load_cert_feeds')
+
 settings = configparser.RawConfigParser()
 settings.read('settings.ini')
 S3_BUCKET_NAME = settings.get('S3', 'S3_BUCKET_NAME')
 
-feed_uris = []
-feed_uris.append(download_sslbl(S3_BUCKET_NAME))
-feed_uris.append(download_dyressl(S3_BUCKET_NAME))
-
-db_conn = redshift_connect(settings)
+downloads = download_feeds(S3_BUCKET_NAME, settings, metrics)
+db_conn = redshift_db.connect(settings)
+# Reloading the table means reloading every feed, so only bother if at least one of them is
+#   different from what was last loaded.  That's checked against what's in S3 rather than whether
+#   the download changed, since an earlier run may have downloaded a feed and then failed to load it
+etags = loaded_etags(db_conn)
+if not any([etags.get(s3_uri) != s3_etag for s3_uri, changed, s3_etag in downloads]):
+    print('No feeds have changed, nothing to load')
+    db_conn.commit()
+    db_conn.close()
+    metrics.summary()
+    metrics.write_outputs(args.metrics_json, args.metrics_prom)
+    sys.exit(0)
+feed_uris = [s3_uri for s3_uri, changed, s3_etag in downloads]
 
-# Create a new temporary table
-cursor = db_conn.cursor()
-query = 'CREATE TABLE feed_certs_new (ts TIMESTAMP NOT NULL, sha1 CHAR(40) DISTKEY SORTKEY,'
-query += ' description VARCHAR(255), source VARCHAR(64))'
-cursor.execute(query)
+# Create a new temporary table, and an empty feed_certs to compare it with on the first run
+feed_columns = '(ts TIMESTAMP NOT NULL, sha1 CHAR(40) DISTKEY SORTKEY,'
+feed_columns += ' description VARCHAR(255), source VARCHAR(64))'
+redshift_db.execute(db_conn, 'CREATE TABLE IF NOT EXISTS feed_certs ' + feed_columns)
+redshift_db.execute(db_conn, 'CREATE TABLE feed_certs_new ' + feed_columns)
+# Every sha1 that's been added to or removed from the feeds, and when
+query = 'CREATE TABLE IF NOT EXISTS feed_changes (ts TIMESTAMP NOT NULL, sha1 CHAR(40) DISTKEY,'
+query += ' change VARCHAR(8))'
+redshift_db.execute(db_conn, query)
 
 for uri in feed_uris:
-    load_file_from_s3(uri, db_conn, settings)
-    
+    with metrics.timer('copy', uri):
+        load_file_from_s3(uri, db_conn, settings)
+    metrics.count('copies')
+
+# Work out which sha1s are new to the feeds and which have dropped out of them.  Only certificates
+#   with those sha1s need feed_match changing, rather than running update_feed_match.sql over the
+#   whole of cert_metadata
+with metrics.timer('feed_delta'):
+    query = 'CREATE TEMP TABLE feed_delta AS'
+    query += ' SELECT sha1, \'added\' AS change FROM (SELECT sha1 FROM feed_certs_new'
+    query += ' WHERE sha1 IS NOT NULL EXCEPT SELECT sha1 FROM feed_certs) added'
+    query += ' UNION ALL SELECT sha1, \'removed\' AS change FROM (SELECT sha1 FROM feed_certs'
+    query += ' WHERE sha1 IS NOT NULL EXCEPT SELECT sha1 FROM feed_certs_new) removed'
+    redshift_db.execute(db_conn, query)
+    query = 'INSERT INTO feed_changes SELECT %s, sha1, change FROM feed_delta'
+    redshift_db.execute(db_conn, query, (datetime.datetime.utcnow(),))
+    for change, label in (('added', 'True'), ('removed', 'False')):
+        count = redshift_db.fetch_one(db_conn, 'SELECT COUNT(*) FROM feed_delta WHERE change = %s',
+                                      (change,))[0]
+        metrics.count('sha1s_' + change, count)
+        query = 'UPDATE cert_metadata SET feed_match = ' + label + ' FROM feed_delta'
+        query += ' WHERE cert_metadata.sha1 = feed_delta.sha1 AND feed_delta.change = %s'
+        with metrics.timer('relabel', change):
+            cursor = redshift_db.execute(db_conn, query, (change,))
+        metrics.count('certs_relabelled', cursor.rowcount)
+        print(str(count) + ' sha1s ' + change + ', ' + str(cursor.rowcount) + ' certificates relabelled')
+    redshift_db.execute(db_conn, 'DROP TABLE feed_delta')
+
 # Use query order suggested here: 
 #   https://www.simple.com/engineering/safe-migrations-with-redshift
 query = 'ALTER TABLE feed_certs RENAME TO feed_certs_old;'
 query += 'ALTER TABLE feed_certs_new RENAME TO feed_certs;'
 query += 'DROP TABLE feed_certs_old;'
-cursor.execute(query)
+redshift_db.execute(db_conn, query)
+record_loaded_etags(db_conn, downloads)
 
 db_conn.commit()
 db_conn.close()
+metrics.summary()
+metrics.write_outputs(args.metrics_json, args.metrics_prom)
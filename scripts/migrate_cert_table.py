@@ -0,0 +1,81 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# Move an existing cert_metadata table to the optimized layout in cert_schema.py with a deep copy:
+#   create the new table, copy every row into it in one bulk INSERT, which sorts it as it goes,
+#   then swap the two tables over.  Column sizes come from the longest values in the table itself,
+#   so the copy can't fail on a value that's too long for its new column
+import argparse
+import cert_schema
+import configparser
+import redshift_db
+
+# Longest value in bytes in each VARCHAR column, all in one pass over the table
+def measure_columns(db_conn, table):
+    columns = [column for column, column_type in cert_schema.cert_columns
+               if column_type.startswith('VARCHAR(')]
+    query = 'SELECT ' + ', '.join(['MAX(OCTET_LENGTH(' + column + '))' for column in columns])
+    query += ' FROM ' + table
+    row = redshift_db.fetch_one(db_conn, query)
+    stats = {}
+    for column, length in zip(columns, row):
+        stats[column] = length or 0
+    return stats
+
+def count_rows(db_conn, table):
+    return redshift_db.fetch_one(db_conn, 'SELECT COUNT(*) FROM ' + table)[0]
+
+def main():
+    parser = argparse.ArgumentParser(description='Deep copy cert_metadata into the optimized '
+                                                 'layout with a sort key and column encodings')
+    parser.add_argument('--table', default='cert_metadata',
+                        help='table to migrate (default: cert_metadata)')
+    parser.add_argument('--column-stats', metavar='FILE',
+                        help='also allow for the longest values in this file written by '
+                             'split_certs_redshift.py --column-stats, e.g. for snapshots still to '
+                             'be loaded')
+    parser.add_argument('--sort-style', choices=['compound', 'interleaved'], default='compound',
+                        help='sort key style (default: compound)')
+    parser.add_argument('--keep-old', action='store_true',
+                        help='keep the original table as <table>_old, e.g. to benchmark against '
+                             'with bench_count_queries.py')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the new table definition without changing anything')
+    args = parser.parse_args()
+
+    settings = configparser.RawConfigParser()
+    settings.read('settings.ini')
+    db_conn = redshift_db.connect(settings)
+
+    stats = measure_columns(db_conn, args.table)
+    if args.column_stats:
+        file_stats = cert_schema.read_column_stats(args.column_stats)
+        for column in file_stats:
+            stats[column] = max(stats.get(column, 0), file_stats[column])
+    new_table = args.table + '_new'
+    query = cert_schema.create_table_query(new_table, True, stats, args.sort_style)
+    if args.dry_run:
+        print(query)
+        return
+
+    redshift_db.execute(db_conn, query)
+    redshift_db.execute(db_conn, 'INSERT INTO ' + new_table + ' SELECT * FROM ' + args.table)
+    old_rows = count_rows(db_conn, args.table)
+    new_rows = count_rows(db_conn, new_table)
+    if old_rows != new_rows:
+        db_conn.rollback()
+        raise RuntimeError('Copied ' + str(new_rows) + ' rows of ' + str(old_rows) + ', nothing changed')
+    # Same swap as load_cert_feeds.py
+    query = 'ALTER TABLE ' + args.table + ' RENAME TO ' + args.table + '_old;'
+    query += 'ALTER TABLE ' + new_table + ' RENAME TO ' + args.table + ';'
+    if not args.keep_old:
+        query += 'DROP TABLE ' + args.table + '_old;'
+    redshift_db.execute(db_conn, query)
+    db_conn.commit()
+    redshift_db.execute(db_conn, 'ANALYZE ' + args.table)
+    db_conn.commit()
+    print('Migrated ' + str(new_rows) + ' rows of ' + args.table)
+    db_conn.close()
+
+if __name__ == '__main__':
+    main()
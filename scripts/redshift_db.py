@@ -0,0 +1,76 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# Redshift connections and queries shared by the scripts.  Connection details come from the
+#   [Redshift] section of settings.ini.  Redshift speaks the PostgreSQL protocol, so pointing
+#   REDSHIFT_HOSTNAME and REDSHIFT_PORT at a local PostgreSQL server with REDSHIFT_SSLMODE set to
+#   disable is enough to try the queries out without a cluster
+import itertools
+import psycopg2
+
+# Open connections, keyed by what they were opened with, so every part of a script that asks for
+#   a connection shares the one SSL session
+connections = {}
+
+# Server-side cursors need names that are unique within the connection
+cursor_numbers = itertools.count()
+
+def setting(settings, name, default):
+    if settings.has_option('Redshift', name) and settings.get('Redshift', name):
+        return settings.get('Redshift', name)
+    return default
+
+def connection_parameters(settings):
+    return { 'host': settings.get('Redshift', 'REDSHIFT_HOSTNAME'),
+             'port': int(setting(settings, 'REDSHIFT_PORT', '5439')),
+             'dbname': settings.get('Redshift', 'REDSHIFT_DATABASE'),
+             'user': settings.get('Redshift', 'REDSHIFT_USER'),
+             'password': settings.get('Redshift', 'REDSHIFT_PASSWORD'),
+             'sslmode': setting(settings, 'REDSHIFT_SSLMODE', 'require'),
+             'connect_timeout': int(setting(settings, 'REDSHIFT_CONNECT_TIMEOUT', '20')) }
+
+# Return the open connection for these settings, connecting if there isn't one yet.  The values
+#   are handed to psycopg2 separately rather than pasted into a connection string, so passwords
+#   with quotes or spaces in them work
+def connect(settings):
+    parameters = connection_parameters(settings)
+    key = tuple(sorted(parameters.items()))
+    if key not in connections or connections[key].closed:
+        connections[key] = psycopg2.connect(**parameters)
+    return connections[key]
+
+def close_all():
+    for db_conn in connections.values():
+        if not db_conn.closed:
+            db_conn.close()
+    connections.clear()
+
+# The credentials clause for a COPY from S3, using the IAM user in the [Copy] section
+def copy_credentials(settings):
+    return ('aws_access_key_id=' + settings.get('Copy', 'COPY_AWS_ACCESS_KEY_ID') +
+            ';aws_secret_access_key=' + settings.get('Copy', 'COPY_AWS_SECRET_KEY'))
+
+# Run a statement with its values passed as parameters, so psycopg2 quotes them for us
+def execute(db_conn, query, params=None):
+    cursor = db_conn.cursor()
+    cursor.execute(query, params)
+    return cursor
+
+def fetch_one(db_conn, query, params=None):
+    cursor = execute(db_conn, query, params)
+    row = cursor.fetchone()
+    cursor.close()
+    return row
+
+# Yield the rows of a query through a named, server-side cursor, itersize rows at a time, so a
+#   large result never has to sit in memory all at once.  Server-side cursors only live as long as
+#   the transaction they were opened in
+def stream(db_conn, query, params=None, itersize=10000):
+    cursor = db_conn.cursor(name='stream_' + str(next(cursor_numbers)))
+    cursor.itersize = itersize
+    try:
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
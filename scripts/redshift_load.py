@@ -3,76 +3,221 @@
 #
 # Load a preprocessed metadata file from Amazon S3 into a Redshift database specified by a config
 #   file.  This script creates the database table nessecary if it does not already exist.
+import argparse
 import boto3
+import cert_schema
 import configparser
-import psycopg2
-    
-def redshift_connect(settings):
-    REDSHIFT_HOSTNAME = settings.get('Redshift', 'REDSHIFT_HOSTNAME')
-    REDSHIFT_DATABASE = settings.get('Redshift', 'REDSHIFT_DATABASE')
-    REDSHIFT_USER     = settings.get('Redshift', 'REDSHIFT_USER')
-    REDSHIFT_PASSWORD = settings.get('Redshift', 'REDSHIFT_PASSWORD')
-    
-    conn_string = 'dbname=\'' + REDSHIFT_DATABASE + '\' port=\'5439\' user=\'' + REDSHIFT_USER + '\''
-    conn_string += ' password=\'' + REDSHIFT_PASSWORD + '\'' + ' host=\'' + REDSHIFT_HOSTNAME + '\''
-    conn_string += ' connect_timeout=20 sslmode=require'
-    return psycopg2.connect(conn_string)
-
-def create_cert_table(db_conn):
+import ingest_metrics
+import json
+import redshift_db
+
+# Make sure our tables are in place.  An existing cert_metadata is left as it is, see
+#   migrate_cert_table.py for moving one to the optimized layout
+def create_cert_table(db_conn, optimized=False, column_stats=None, sort_style='compound'):
     cursor = db_conn.cursor()
-    query = 'CREATE TABLE IF NOT EXISTS cert_metadata(date DATE, sha1 CHAR(40) DISTKEY,'
-    query += ' version VARCHAR(16), serial_number VARCHAR(255),'
-    query += ' subject VARCHAR(8192), subject_c VARCHAR(2048), subject_cn VARCHAR(2048),'
-    query += ' subject_l VARCHAR(2048), subject_o VARCHAR(2048), subject_ou VARCHAR(2048),'
-    query += ' subject_st VARCHAR(2048), subject_emailaddress VARCHAR(2048),'
-    query += ' subject_unstructuredname VARCHAR(2048), subject_serialnumber VARCHAR(2048),'
-    # Same data fields as above, but subject -> issuer
-    query += ' issuer VARCHAR(8192), issuer_c VARCHAR(2048), issuer_cn VARCHAR(2048),'
-    query += ' issuer_l VARCHAR(2048), issuer_o VARCHAR(2048), issuer_ou VARCHAR(2048),'
-    query += ' issuer_st VARCHAR(2048), issuer_emailaddress VARCHAR(2048),'
-    query += ' issuer_unstructuredname VARCHAR(2048), issuer_serialnumber VARCHAR(2048),'
-    
-    query += ' not_valid_before TIMESTAMP, not_valid_before_raw VARCHAR(255),'
-    query += ' not_valid_after TIMESTAMP, not_valid_after_raw VARCHAR(255),'
-    query += ' duration BIGINT, key_algorithm VARCHAR(255), sig_algorithm VARCHAR(255),'
-    query += ' key_type VARCHAR(255), key_length INT, exponent BIGINT, curve VARCHAR(255),'
-    query += ' size INT, self_signed BOOLEAN, feed_match BOOLEAN);'
+    cursor.execute(cert_schema.create_table_query('cert_metadata', optimized, column_stats,
+                                                  sort_style))
+    # Filled from the .gone files written by split_certs_redshift.py --delta-index.  In delta mode
+    #   each certificate is only loaded into cert_metadata when it first shows up, so its date is
+    #   when it was first seen, and this holds when it was last seen once it's gone again.  Rows
+    #   are cleared again by the .returned files when a certificate comes back
+    query = 'CREATE TABLE IF NOT EXISTS cert_last_seen(sha1 CHAR(40) DISTKEY SORTKEY,'
+    query += ' last_seen DATE);'
     cursor.execute(query)
 
-def load_file_from_s3(s3_uri, db_conn, settings):
-    COPY_AWS_ACCESS_KEY_ID = settings.get('Copy', 'COPY_AWS_ACCESS_KEY_ID')
-    COPY_AWS_SECRET_KEY    = settings.get('Copy', 'COPY_AWS_SECRET_KEY')
-    
-    cursor = db_conn.cursor()
-    copy_query = 'COPY cert_metadata FROM \'' + s3_uri + '\''
-    copy_query += ' credentials \'aws_access_key_id=' + COPY_AWS_ACCESS_KEY_ID
-    copy_query += ';aws_secret_access_key=' + COPY_AWS_SECRET_KEY + '\''
-    copy_query += ' delimiter \'|\' DATEFORMAT AS \'YYYYMMDD\' TIMEFORMAT AS \'epochsecs\''
-    copy_query += ' NULL AS \'-\' IGNOREHEADER 1 REMOVEQUOTES ESCAPE TRUNCATECOLUMNS'
-    cursor.execute(copy_query)
+# Work out what split_certs_redshift.py wrote from the file extension: pipe-delimited text,
+#   optionally gzip or zstd compressed, Parquet, or the sha1s of certificates that have gone or
+#   come back
+def file_format(s3_uri):
+    if s3_uri.endswith('.gone'):
+        return 'gone'
+    elif s3_uri.endswith('.returned'):
+        return 'returned'
+    elif s3_uri.endswith('.parquet'):
+        return 'parquet'
+    elif s3_uri.endswith('.gz'):
+        return 'gzip'
+    elif s3_uri.endswith('.zst'):
+        return 'zstd'
+    return 'text'
+
+# The table each format is loaded into, cert_metadata unless listed here
+format_tables = { 'gone': 'cert_last_seen',
+                  'returned': 'cert_returned' }
+
+# The original layout's columns are wide enough that anything longer is junk, so those values are
+#   cut short.  Columns sized from column stats by --schema optimized are only just wide enough, so
+#   for those truncate is False and a value that doesn't fit fails the load rather than silently
+#   losing its end, which would stop it matching in count_occurances.py
+def copy_options(data_format, truncate=True):
+    # Parquet columns are already typed, so none of the text parsing options apply
+    if data_format == 'parquet':
+        return ' FORMAT AS PARQUET'
+    options = ' delimiter \'|\' DATEFORMAT AS \'YYYYMMDD\' TIMEFORMAT AS \'epochsecs\''
+    options += ' NULL AS \'-\' IGNOREHEADER 1 REMOVEQUOTES ESCAPE'
+    if truncate:
+        options += ' TRUNCATECOLUMNS'
+    if data_format == 'gzip':
+        options += ' GZIP'
+    elif data_format == 'zstd':
+        options += ' ZSTD'
+    return options
+
+def load_file_from_s3(s3_uri, db_conn, settings, data_format=None, manifest=False, truncate=True):
+    if data_format == None:
+        data_format = file_format(s3_uri)
+    table = format_tables.get(data_format, 'cert_metadata')
+    if data_format == 'returned':
+        redshift_db.execute(db_conn, 'CREATE TEMP TABLE cert_returned(sha1 CHAR(40),'
+                                     ' returned DATE)')
+    copy_query = 'COPY ' + table + ' FROM %s credentials %s'
+    copy_query += copy_options(data_format, truncate)
+    if manifest:
+        copy_query += ' MANIFEST'
+    redshift_db.execute(db_conn, copy_query, (s3_uri, redshift_db.copy_credentials(settings)))
+    if data_format == 'returned':
+        clear_returned(db_conn)
     print(s3_uri + ' loaded')
 
-# Read in our configuration file
-settings = configparser.RawConfigParser()
-settings.read('settings.ini')
-
-db_conn = redshift_connect(settings)
-# Make sure our table is in place
-create_cert_table(db_conn)
-
-s3 = boto3.client('s3')
-S3_BUCKET_NAME = settings.get('S3', 'S3_BUCKET_NAME')
-
-# NOTE: If you get an error on the line below that looks like thew following:
-#     AttributeError: 'S3' object has no attribute 'list_objects_v2'
-#   make sure you have the latest boto3 and botocore python packages installed 
-response = s3.list_objects_v2(Bucket=S3_BUCKET_NAME)
-if 'Contents' not in response:
-    print('No objects found to load in s3 bucket: ' + S3_BUCKET_NAME)
-else:    
-    for s3_object in response['Contents']:
-        if s3_object['Size'] > 0:
-            s3_uri = 's3://' + S3_BUCKET_NAME + '/' + s3_object['Key']
-            load_file_from_s3(s3_uri, db_conn, settings)
-    db_conn.commit()
-db_conn.close()
+# A certificate that's come back isn't gone any more.  Only rows from before it came back are
+#   cleared, so it doesn't matter which order the .gone and .returned files are loaded in
+def clear_returned(db_conn):
+    query = 'DELETE FROM cert_last_seen USING cert_returned'
+    query += ' WHERE cert_last_seen.sha1 = cert_returned.sha1'
+    query += ' AND cert_last_seen.last_seen < cert_returned.returned'
+    redshift_db.execute(db_conn, query)
+    redshift_db.execute(db_conn, 'DROP TABLE cert_returned')
+
+# The size of each character column of a table, as it is in the database
+def column_sizes(db_conn, table='cert_metadata'):
+    query = 'SELECT column_name, character_maximum_length FROM information_schema.columns'
+    query += ' WHERE table_name = %s AND character_maximum_length IS NOT NULL'
+    cursor = redshift_db.execute(db_conn, query, (table,))
+    sizes = dict(cursor.fetchall())
+    cursor.close()
+    return sizes
+
+# Make sure the values described by column_stats fit cert_metadata as it is.  Returns whether the
+#   COPYs should truncate, and raises ValueError naming the columns that are too narrow
+def check_column_sizes(db_conn, column_stats):
+    sizes = column_sizes(db_conn)
+    if column_stats:
+        too_long = cert_schema.oversized_columns(sizes, column_stats)
+        if len(too_long) > 0:
+            raise ValueError('cert_metadata is too narrow for the values in the column stats ('
+                             + ', '.join(too_long) + '), run migrate_cert_table.py with '
+                             '--column-stats to widen it first')
+    return not cert_schema.narrowed(sizes)
+
+# Split a s3://bucket/key URI into its bucket and key
+def split_s3_uri(s3_uri):
+    bucket_name, key = s3_uri[5:].split('/', 1)
+    return bucket_name, key
+
+# Redshift only loads files in parallel when they're part of the same COPY, so rather than one
+#   COPY per object we list them all in manifests.  Every file in a COPY has to share the same
+#   options, so there's one manifest for each file format found in the bucket
+def build_manifests(s3, bucket_name):
+    manifests = {}
+    # NOTE: If you get an error on the line below that looks like thew following:
+    #     AttributeError: 'S3' object has no attribute 'list_objects_v2'
+    #   make sure you have the latest boto3 and botocore python packages installed 
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name):
+        for s3_object in page.get('Contents', []):
+            if s3_object['Size'] == 0 or s3_object['Key'].endswith('.manifest'):
+                continue
+            s3_uri = 's3://' + bucket_name + '/' + s3_object['Key']
+            entry = { 'url': s3_uri,
+                      'mandatory': True,
+                      'meta': { 'content_length': s3_object['Size'] } }
+            manifests.setdefault(file_format(s3_uri), []).append(entry)
+    return manifests
+
+def upload_manifest(s3, bucket_name, key, entries):
+    body = json.dumps({ 'entries': entries }, indent=2)
+    s3.put_object(Bucket=bucket_name, Key=key, Body=body.encode())
+    return 's3://' + bucket_name + '/' + key
+
+# Work out the format of the files in an existing manifest, such as the ones written by
+#   split_certs_redshift.py --shards
+def manifest_format(s3, manifest_uri):
+    bucket_name, key = split_s3_uri(manifest_uri)
+    manifest = json.loads(s3.get_object(Bucket=bucket_name, Key=key)['Body'].read().decode())
+    if len(manifest['entries']) == 0:
+        return 'text'
+    return file_format(manifest['entries'][0]['url'])
+
+# S3_ENDPOINT_URL points boto3 at an S3 compatible service other than Amazon S3, e.g. a local one
+def s3_client(settings):
+    s3_endpoint = None
+    if settings.has_option('S3', 'S3_ENDPOINT_URL') and settings.get('S3', 'S3_ENDPOINT_URL'):
+        s3_endpoint = settings.get('S3', 'S3_ENDPOINT_URL')
+    return boto3.client('s3', endpoint_url=s3_endpoint)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load converted certificate metadata from S3 into '
+                                                 'Redshift')
+    parser.add_argument('--manifest',
+                        help='s3:// URI of a COPY manifest to load instead of everything in the '
+                             'configured bucket')
+    parser.add_argument('--schema', choices=['original', 'optimized'], default='original',
+                        help='layout for cert_metadata if it doesn\'t exist yet.  optimized adds '
+                             'a sort key and column encodings (default: original)')
+    parser.add_argument('--column-stats', metavar='FILE',
+                        help='with --schema optimized, size the VARCHAR columns from this file '
+                             'written by split_certs_redshift.py --column-stats.  It should cover '
+                             'every snapshot that will ever be loaded, since longer values won\'t '
+                             'fit.  The values in it are also checked against an existing table '
+                             'before loading')
+    parser.add_argument('--sort-style', choices=['compound', 'interleaved'], default='compound',
+                        help='sort key style for --schema optimized (default: compound)')
+    ingest_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics = ingest_metrics.Metrics('redshift_load')
+
+    # Read in our configuration file
+    settings = configparser.RawConfigParser()
+    settings.read('settings.ini')
+
+    db_conn = redshift_db.connect(settings)
+    column_stats = None
+    if args.column_stats:
+        column_stats = cert_schema.read_column_stats(args.column_stats)
+    create_cert_table(db_conn, args.schema == 'optimized', column_stats, args.sort_style)
+    try:
+        truncate = check_column_sizes(db_conn, column_stats)
+    except ValueError as e:
+        parser.error(str(e))
+
+    s3 = s3_client(settings)
+    S3_BUCKET_NAME = settings.get('S3', 'S3_BUCKET_NAME')
+
+    if args.manifest:
+        with metrics.timer('copy', args.manifest):
+            load_file_from_s3(args.manifest, db_conn, settings,
+                              manifest_format(s3, args.manifest), True, truncate)
+        metrics.count('copies')
+        with metrics.timer('commit'):
+            db_conn.commit()
+    else:
+        manifests = build_manifests(s3, S3_BUCKET_NAME)
+        if len(manifests) == 0:
+            print('No objects found to load in s3 bucket: ' + S3_BUCKET_NAME)
+        else:
+            for data_format in sorted(manifests):
+                key = 'manifests/cert_metadata_' + data_format + '.manifest'
+                manifest_uri = upload_manifest(s3, S3_BUCKET_NAME, key, manifests[data_format])
+                with metrics.timer('copy', manifest_uri):
+                    load_file_from_s3(manifest_uri, db_conn, settings, data_format, True,
+                                      truncate)
+                metrics.count('copies')
+                metrics.count('files', len(manifests[data_format]))
+            with metrics.timer('commit'):
+                db_conn.commit()
+    db_conn.close()
+    metrics.summary()
+    metrics.write_outputs(args.metrics_json, args.metrics_prom)
+
+if __name__ == '__main__':
+    main()
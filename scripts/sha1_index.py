@@ -0,0 +1,180 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# A sorted file of raw sha1s, used to tell which certificates in a snapshot were already in the
+#   previous one.  The layout borrows from git's pack index: a header with the scan date and a 256
+#   entry fanout table counting the sha1s that start with each byte value or less, followed by the
+#   sha1s themselves at 20 bytes each.  Lookups are a binary search over the memory mapped file and
+#   the index is built with an external sort, so neither ever has to fit in memory
+import heapq
+import mmap
+import os
+import struct
+
+index_magic = b'SHA1IDX1'
+header_format = '>8s32s256Q'
+header_size = struct.calcsize(header_format)
+record_size = 20
+
+# Records read from disk at a time when streaming through an index or a sorted run
+chunk_records = 65536
+
+# The 20 byte sha1 for a hex string, or None if it isn't one
+def sha1_bytes(sha1):
+    if len(sha1) != 40:
+        return None
+    try:
+        raw = bytes.fromhex(sha1)
+    except ValueError:
+        return None
+    if len(raw) != record_size:
+        return None
+    return raw
+
+def read_records(path, offset=0):
+    with open(path, 'rb') as record_file:
+        record_file.seek(offset)
+        while True:
+            chunk = record_file.read(record_size * chunk_records)
+            if len(chunk) == 0:
+                break
+            for start in range(0, len(chunk), record_size):
+                yield chunk[start:start + record_size]
+
+class Sha1Index(object):
+    def __init__(self, path):
+        self.path = path
+        self.index_file = open(path, 'rb')
+        fields = struct.unpack(header_format, self.index_file.read(header_size))
+        if fields[0] != index_magic:
+            raise ValueError(path + ' is not a sha1 index')
+        self.scan_date = fields[1].rstrip(b'\0').decode('ascii')
+        self.fanout = fields[2:]
+        self.count = self.fanout[255]
+        self.data = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def record(self, position):
+        start = header_size + position * record_size
+        return self.data[start:start + record_size]
+
+    # Only the sha1s sharing the first byte need to be searched, which the fanout table gives us
+    def __contains__(self, sha1):
+        first = sha1[0]
+        low = 0
+        if first > 0:
+            low = self.fanout[first - 1]
+        high = self.fanout[first]
+        end = high
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle) < sha1:
+                low = middle + 1
+            else:
+                high = middle
+        return low < end and self.record(low) == sha1
+
+    def __len__(self):
+        return self.count
+
+    # Read from the mapping rather than the path, so an index that's been replaced on disk since
+    #   it was opened still reads back as it was
+    def __iter__(self):
+        for first in range(0, self.count, chunk_records):
+            last = min(first + chunk_records, self.count)
+            chunk = self.data[header_size + first * record_size:header_size + last * record_size]
+            for start in range(0, len(chunk), record_size):
+                yield chunk[start:start + record_size]
+
+    def close(self):
+        self.data.close()
+        self.index_file.close()
+
+# Sorts any number of sha1s by writing sorted runs of run_size to disk and merging them
+class Sha1Sorter(object):
+    def __init__(self, temp_prefix, run_size=1000000):
+        self.temp_prefix = temp_prefix
+        self.run_size = run_size
+        self.pending = []
+        self.run_paths = []
+
+    def add(self, sha1):
+        self.pending.append(sha1)
+        if len(self.pending) >= self.run_size:
+            self.write_run()
+
+    def write_run(self):
+        self.pending.sort()
+        path = self.temp_prefix + '.run%04d' % len(self.run_paths)
+        with open(path, 'wb') as run_file:
+            run_file.write(b''.join(self.pending))
+        self.run_paths.append(path)
+        self.pending = []
+
+    # Every sha1 added, in order and without duplicates
+    def sorted(self):
+        if len(self.run_paths) == 0:
+            records = sorted(self.pending)
+        else:
+            if len(self.pending) > 0:
+                self.write_run()
+            records = heapq.merge(*[read_records(path) for path in self.run_paths])
+        return unique(records)
+
+    def cleanup(self):
+        for path in self.run_paths:
+            os.remove(path)
+        self.run_paths = []
+        self.pending = []
+
+# Drop the repeats from a sorted stream of sha1s
+def unique(sha1s):
+    last = None
+    for sha1 in sha1s:
+        if sha1 != last:
+            yield sha1
+            last = sha1
+
+# Every sha1 in any of the sorted streams, in order and without duplicates
+def merge_sorted(*sha1s):
+    return unique(heapq.merge(*sha1s))
+
+# Write an index of the sorted sha1s, replacing path once it's complete.  When there's a previous
+#   index, on_gone is called with each sha1 that was in it but isn't in the new one, found with a
+#   merge join of the two sorted lists.  Returns the number of sha1s written
+def write_index(path, scan_date, sha1s, previous=None, on_gone=None):
+    counts = [0] * 256
+    temp_path = path + '.tmp'
+    old_sha1s = iter(previous or [])
+    old_sha1 = next(old_sha1s, None)
+    with open(temp_path, 'wb') as index_file:
+        # Leave room for the header, which can't be filled in until we've seen every sha1
+        index_file.write(b'\0' * header_size)
+        buffered = []
+        for sha1 in sha1s:
+            while old_sha1 != None and old_sha1 < sha1:
+                if on_gone != None:
+                    on_gone(old_sha1)
+                old_sha1 = next(old_sha1s, None)
+            if old_sha1 == sha1:
+                old_sha1 = next(old_sha1s, None)
+            counts[sha1[0]] += 1
+            buffered.append(sha1)
+            if len(buffered) >= chunk_records:
+                index_file.write(b''.join(buffered))
+                buffered = []
+        index_file.write(b''.join(buffered))
+        while old_sha1 != None:
+            if on_gone != None:
+                on_gone(old_sha1)
+            old_sha1 = next(old_sha1s, None)
+        fanout = []
+        total = 0
+        for count in counts:
+            total += count
+            fanout.append(total)
+        index_file.seek(0)
+        index_file.write(struct.pack(header_format, index_magic, scan_date.encode('ascii'), *fanout))
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    os.rename(temp_path, path)
+    return total
@@ -3,12 +3,48 @@
 #
 # Take in an unzipped file of certificates from Project Sonar and create a metadata TSV file
 #   in a format similar to that of Bro but with different fields and a simpler 1-line header
+import argparse
 import base64
 import calendar
+import cert_feeds
+import collections
+import configparser
 import datetime
+import functools
+import gzip
+import ingest_metrics
+import io
+import json
+import multiprocessing
+import os
 import re
+import sha1_index
+import sqlite3
 import subprocess
 import sys
+import time
+
+# The cryptography package lets us decode certificates in-process rather than starting an openssl
+#   process for every line.  If it isn't installed we fall back to parsing 'openssl x509' output
+try:
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import dsa, ec, rsa
+except ImportError:
+    x509 = None
+
+# zstandard is only needed when writing zstd compressed output
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# pyarrow is only needed when writing Parquet output
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 field_names = [ 'date',
                 'sha1',
@@ -48,9 +84,110 @@ field_names = [ 'date',
                 'size',
                 'self_signed',
                 'feed_match' ]
+
+# Parquet column types for each field, matching the cert_metadata table created by
+#   redshift_load.py.  COPY matches Parquet columns to the table by position, so these have to
+#   stay in the same order as field_names
+parquet_types = { 'date': 'date',
+                  'version': 'string',
+                  'not_valid_before': 'timestamp',
+                  'not_valid_after': 'timestamp',
+                  'duration': 'int64',
+                  'key_length': 'int32',
+                  'exponent': 'int64',
+                  'size': 'int32',
+                  'self_signed': 'bool',
+                  'feed_match': 'bool' }
+
+# Parquet files are compressed internally, so --compress picks the codec instead
+parquet_codecs = { 'none': 'SNAPPY',
+                   'gzip': 'GZIP',
+                   'zstd': 'ZSTD' }
+
+# Names openssl prints for the signature and public key algorithms we commonly see
+algorithm_names = { '1.2.840.113549.1.1.1': 'rsaEncryption',
+                    '1.2.840.113549.1.1.2': 'md2WithRSAEncryption',
+                    '1.2.840.113549.1.1.3': 'md4WithRSAEncryption',
+                    '1.2.840.113549.1.1.4': 'md5WithRSAEncryption',
+                    '1.2.840.113549.1.1.5': 'sha1WithRSAEncryption',
+                    '1.2.840.113549.1.1.10': 'rsassaPss',
+                    '1.2.840.113549.1.1.11': 'sha256WithRSAEncryption',
+                    '1.2.840.113549.1.1.12': 'sha384WithRSAEncryption',
+                    '1.2.840.113549.1.1.13': 'sha512WithRSAEncryption',
+                    '1.2.840.113549.1.1.14': 'sha224WithRSAEncryption',
+                    '1.3.14.3.2.29': 'sha1WithRSA',
+                    '1.2.840.10040.4.1': 'dsaEncryption',
+                    '1.2.840.10040.4.3': 'dsaWithSHA1',
+                    '2.16.840.1.101.3.4.3.1': 'dsa_with_SHA224',
+                    '2.16.840.1.101.3.4.3.2': 'dsa_with_SHA256',
+                    '1.2.840.10045.2.1': 'id-ecPublicKey',
+                    '1.2.840.10045.4.1': 'ecdsa-with-SHA1',
+                    '1.2.840.10045.4.3.1': 'ecdsa-with-SHA224',
+                    '1.2.840.10045.4.3.2': 'ecdsa-with-SHA256',
+                    '1.2.840.10045.4.3.3': 'ecdsa-with-SHA384',
+                    '1.2.840.10045.4.3.4': 'ecdsa-with-SHA512',
+                    '1.3.101.112': 'ED25519',
+                    '1.3.101.113': 'ED448' }
+
+# Short names openssl uses for distinguished name attributes
+name_attributes = { '2.5.4.3': 'CN',
+                    '2.5.4.4': 'SN',
+                    '2.5.4.5': 'serialNumber',
+                    '2.5.4.6': 'C',
+                    '2.5.4.7': 'L',
+                    '2.5.4.8': 'ST',
+                    '2.5.4.9': 'street',
+                    '2.5.4.10': 'O',
+                    '2.5.4.11': 'OU',
+                    '2.5.4.12': 'title',
+                    '2.5.4.13': 'description',
+                    '2.5.4.15': 'businessCategory',
+                    '2.5.4.17': 'postalCode',
+                    '2.5.4.41': 'name',
+                    '2.5.4.42': 'GN',
+                    '2.5.4.43': 'initials',
+                    '2.5.4.46': 'dnQualifier',
+                    '2.5.4.65': 'pseudonym',
+                    '2.5.4.97': 'organizationIdentifier',
+                    '1.2.840.113549.1.9.1': 'emailAddress',
+                    '1.2.840.113549.1.9.2': 'unstructuredName',
+                    '1.2.840.113549.1.9.8': 'unstructuredAddress',
+                    '0.9.2342.19200300.100.1.1': 'UID',
+                    '0.9.2342.19200300.100.1.25': 'DC',
+                    '1.3.6.1.4.1.311.60.2.1.1': 'jurisdictionL',
+                    '1.3.6.1.4.1.311.60.2.1.2': 'jurisdictionST',
+                    '1.3.6.1.4.1.311.60.2.1.3': 'jurisdictionC' }
+
+# A few curves have different names in openssl than in the cryptography package
+curve_names = { 'secp192r1': 'prime192v1',
+                'secp256r1': 'prime256v1' }
+
+key_types = { 'rsaEncryption': 'rsa',
+              'id-ecPublicKey': 'ecdsa',
+              'dsaEncryption': 'dsa' }
+
+# File extensions Redshift COPY uses to recognize each output compression
+output_extensions = { 'none': '',
+                      'gzip': '.gz',
+                      'zstd': '.zst' }
+
+month_names = [ 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec' ]
+
+# Fields that are loaded into VARCHAR columns, whose longest values --column-stats keeps track of
+string_fields = [field for field in field_names if parquet_types.get(field, 'string') == 'string']
+
+# A certificate without these is still written out, but is counted as missing fields
+required_fields = [ 'enc_subject', 'enc_issuer', 'not_valid_before', 'not_valid_after' ]
+
+# Counters and timers for the batch being converted.  convert_batch hands a snapshot of these
+#   back with its output, and main merges them into the numbers for the whole run
+batch_metrics = ingest_metrics.Metrics('split_certs')
     
 # Convert the time from a string to a UNIX-time integer
 def convert_time(time_string):
+    epoch_seconds = fast_convert_time(time_string)
+    if epoch_seconds != None:
+        return epoch_seconds
     timestamp = None
     try:
         timestamp = datetime.datetime.strptime(time_string, '%b %d %H:%M:%S %Y %Z')
@@ -64,9 +201,42 @@ def convert_time(time_string):
     else:
         return None
     
+# openssl always prints times the same way, e.g. 'Jan  1 00:00:00 2016 GMT', so we can work out the
+#   epoch seconds directly rather than going through strptime.  Anything that doesn't look exactly
+#   like that returns None and is left to strptime
+time_pattern = re.compile('([A-Z][a-z][a-z]) +([0-9][0-9]?) ([0-9][0-9]?):([0-9][0-9]?):([0-9][0-9]?) '
+                          '([0-9][0-9][0-9][0-9])(?: GMT)?$')
+month_numbers = { 'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+                  'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12 }
+days_before_month = [ 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334 ]
+days_in_month = [ 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31 ]
+
+def fast_convert_time(time_string):
+    match = time_pattern.match(time_string)
+    if match == None or match.group(1) not in month_numbers:
+        return None
+    month = month_numbers[match.group(1)]
+    day = int(match.group(2))
+    hour = int(match.group(3))
+    minute = int(match.group(4))
+    second = int(match.group(5))
+    year = int(match.group(6))
+    leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    month_length = days_in_month[month - 1]
+    if month == 2 and leap:
+        month_length = 29
+    if year < 1 or day < 1 or day > month_length or hour > 23 or minute > 59 or second > 59:
+        return None
+    # Leap days between 1970 and the start of this year.  There were 477 of them before 1970
+    leap_days = (year - 1) // 4 - (year - 1) // 100 + (year - 1) // 400 - 477
+    days = (year - 1970) * 365 + leap_days + days_before_month[month - 1] + day - 1
+    if month > 2 and leap:
+        days += 1
+    return ((days * 24 + hour) * 60 + minute) * 60 + second
+
 # Take an issuer or subject string with subfields like below and split it up into a dictionary
 # C=GB,ST=Yorks,L=York,O=MyCompany Ltd.,OU=IT,CN=localhost
-def split_subfields(string):
+def split_subfields(string, errors=None):
     output = {}
     transformed = string.replace('/emailAddress=', ',emailAddress=')
     transformed = transformed.replace('/serialNumber=', ',serialNumber=')
@@ -75,11 +245,144 @@ def split_subfields(string):
     for pair in pairs:
         fields = pair.split('=', 1)
         if len(fields) != 2:
-            #print('ERROR: Unrecognized string: ' + pair)
+            if errors != None:
+                errors.append(pair)
             continue
         output[fields[0]] = fields[1]
     return output
     
+# Add the escaped name string and each of its escaped subfields to the output dictionary, e.g.
+#   output['enc_subject'] and output['enc_subject_CN']
+def add_name_fields(output, prefix, name_string):
+    escaped, subfields, error_count = name_cache(name_string)
+    output[prefix] = escaped
+    for subfield, value in subfields:
+        output[prefix + '_' + subfield] = value
+    if error_count > 0:
+        batch_metrics.count('subfield_errors', error_count)
+
+# The escaped name and its escaped subfields, as a tuple so the cached copy can't be changed by
+#   whoever uses it.  A handful of CAs issue most of the certificates in a scan, so the same issuer
+#   strings come up over and over.  See name_cache
+def parse_name(name_string):
+    name_string = name_string.replace(', ', ',')
+    errors = []
+    subfields = split_subfields(name_string, errors)
+    escaped = re.escape(name_string)
+    items = []
+    for subfield in subfields:
+        value = re.escape(subfields[subfield])
+        if job_options.get('intern_names'):
+            value = sys.intern(value)
+        items.append((subfield, value))
+    if job_options.get('intern_names'):
+        escaped = sys.intern(escaped)
+    return (escaped, tuple(items), len(errors))
+
+# Format the time the same way openssl does, e.g. 'Jan  1 00:00:00 2016 GMT'
+def format_time(timestamp):
+    return '%s %2d %02d:%02d:%02d %d GMT' % (month_names[timestamp.month - 1], timestamp.day,
+                                              timestamp.hour, timestamp.minute, timestamp.second,
+                                              timestamp.year)
+
+# Format the serial number the way openssl_output_to_dict does.  openssl prints serials that fit
+#   in a signed 64-bit integer in hex and anything larger as a list of bytes, after '(Negative)'
+#   if it's negative.  -1 gets the list of bytes too, as openssl can't tell it from an error
+def format_serial(serial_number):
+    sign = ''
+    if serial_number >= 2 ** 63 or serial_number < -2 ** 63 or serial_number == -1:
+        if serial_number < 0:
+            sign = '(NEGATIVE)'
+        serial_string = '%X' % abs(serial_number)
+        if len(serial_string) % 2 == 1:
+            serial_string = '0' + serial_string
+        return sign + serial_string
+    if serial_number < 0:
+        sign = '-'
+    return sign + '%X' % abs(serial_number)
+
+# Produce the same name string openssl prints for an issuer or subject.  openssl builds a string
+#   like '/C=GB/ST=Yorks/CN=localhost/emailAddress=a@b.com' and then only turns a '/' into ', '
+#   when it's followed by a one or two letter upper case field name
+def name_to_openssl_string(name):
+    oneline = ''
+    for rdn in name.rdns:
+        separator = '/'
+        for attribute in rdn:
+            dotted = attribute.oid.dotted_string
+            key = name_attributes.get(dotted, dotted)
+            value = ''
+            for byte in bytearray(attribute.value.encode('utf-8')):
+                if byte < 0x20 or byte > 0x7e:
+                    value += '\\x%02X' % byte
+                else:
+                    value += chr(byte)
+            oneline += separator + key + '=' + value
+            separator = '+'
+    return re.sub('/(?=[A-Z][A-Z]?=)', ', ', oneline[1:])
+
+# Bounded caches in front of parse_name and name_to_openssl_string.  init_worker replaces these
+#   with ones of the size asked for on the command line
+name_cache_size = 65536
+name_cache = functools.lru_cache(maxsize=name_cache_size)(parse_name)
+name_string_cache = functools.lru_cache(maxsize=name_cache_size)(name_to_openssl_string)
+
+# Decode a DER certificate in-process and produce the same dictionary as openssl_output_to_dict
+def der_to_dict(cert_der):
+    output = {}
+    cert = x509.load_der_x509_certificate(cert_der, default_backend())
+    output['version'] = cert.version.value + 1
+    output['serial_number'] = format_serial(cert.serial_number)
+    dotted = cert.signature_algorithm_oid.dotted_string
+    output['sig_algorithm'] = algorithm_names.get(dotted, dotted)
+    add_name_fields(output, 'enc_issuer', name_string_cache(cert.issuer))
+    add_name_fields(output, 'enc_subject', name_string_cache(cert.subject))
+
+    # Newer versions of cryptography deprecate the naive datetimes in favor of the _utc variants
+    not_before = getattr(cert, 'not_valid_before_utc', None) or cert.not_valid_before
+    not_after = getattr(cert, 'not_valid_after_utc', None) or cert.not_valid_after
+    output['not_valid_before'] = int(calendar.timegm(not_before.utctimetuple()))
+    output['not_valid_before_raw'] = '\'' + format_time(not_before) + '\''
+    output['not_valid_after'] = int(calendar.timegm(not_after.utctimetuple()))
+    output['not_valid_after_raw'] = '\'' + format_time(not_after) + '\''
+
+    public_key = cert.public_key()
+    if isinstance(public_key, rsa.RSAPublicKey):
+        output['key_algorithm'] = 'rsaEncryption'
+        output['key_length'] = public_key.key_size
+        output['exponent'] = public_key.public_numbers().e
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        output['key_algorithm'] = 'id-ecPublicKey'
+        output['key_length'] = public_key.curve.key_size
+        output['curve'] = curve_names.get(public_key.curve.name, public_key.curve.name)
+    elif isinstance(public_key, dsa.DSAPublicKey):
+        output['key_algorithm'] = 'dsaEncryption'
+        output['key_length'] = public_key.key_size
+    if hasattr(cert, 'public_key_algorithm_oid'):
+        dotted = cert.public_key_algorithm_oid.dotted_string
+        output['key_algorithm'] = algorithm_names.get(dotted, dotted)
+    if output.get('key_algorithm') in key_types:
+        output['key_type'] = key_types[output['key_algorithm']]
+    return output
+
+# Run the certificate through 'openssl x509' and parse the text it prints
+def openssl_decode(cert_der):
+    p = subprocess.Popen(['openssl', 'x509', '-inform', 'der', '-text', '-noout', '-nameopt', 'compat'],
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE)
+    cert_decode = p.communicate(input=cert_der)[0]
+    return openssl_output_to_dict(cert_decode.decode('utf-8', 'replace'))
+
+# Decode the certificate natively when we can.  Scan data is full of oddly formed certificates
+#   that the cryptography package refuses to load, so anything it can't handle goes to openssl
+def decode_cert(cert_der):
+    if x509 is not None:
+        try:
+            return der_to_dict(cert_der)
+        except Exception:
+            batch_metrics.count('openssl_fallbacks')
+    return openssl_decode(cert_der)
+
 # Takes the output from the openssl x509 decoder and produces a dictionary
 def openssl_output_to_dict(openssl_output):
     output = {}
@@ -107,11 +410,7 @@ def openssl_output_to_dict(openssl_output):
         elif stripped.startswith('Signature Algorithm: '):
             output['sig_algorithm'] = stripped[21:]
         elif stripped.startswith('Issuer: '):
-            issuer = stripped[8:].replace(', ', ',')
-            output['enc_issuer'] = re.escape(issuer)
-            subfields = split_subfields(issuer)
-            for subfield in subfields:
-                output['enc_issuer_' + subfield] = re.escape(subfields[subfield])
+            add_name_fields(output, 'enc_issuer', stripped[8:])
         elif stripped.startswith('Not Before: '):
             split = stripped[12:].split(',')
             not_before_string = split[0]
@@ -132,21 +431,23 @@ def openssl_output_to_dict(openssl_output):
                 output['not_valid_after'] = timestamp
             output['not_valid_after_raw'] = '\'' + not_after_string + '\''
         elif stripped.startswith('Subject: '):
-            subject = stripped[9:].replace(', ', ',')
-            output['enc_subject'] = re.escape(subject)
-            subfields = split_subfields(subject)
-            for subfield in subfields:
-                output['enc_subject_' + subfield] = re.escape(subfields[subfield])
+            add_name_fields(output, 'enc_subject', stripped[9:])
         elif stripped.startswith('Public Key Algorithm: '):
             output['key_algorithm'] = stripped[22:]
+            if output['key_algorithm'] in key_types:
+                output['key_type'] = key_types[output['key_algorithm']]
         elif stripped.startswith('RSA Public Key: ('):
             output['key_type'] = 'rsa'
             output['key_length'] = int(stripped[17:].replace(' bit)', ''))
+        elif stripped.startswith('Public-Key: ('):
+            # Newer versions of openssl print the key size this way for every key type
+            output['key_length'] = int(stripped[13:].replace(' bit)', ''))
         elif stripped.startswith('EC Public Key:'):
             output['key_type'] = 'ecdsa'
         elif stripped.startswith('ASN1 OID: '):
             output['curve'] = stripped[10:]
-            output['key_length'] = 256 # This is a guess based on what we've observed
+            if 'key_length' not in output:
+                output['key_length'] = 256 # This is a guess based on what we've observed
         elif stripped.startswith('Exponent: '):
             exponent_string = stripped[10:]
             fields = exponent_string.split(' ')
@@ -167,7 +468,8 @@ def print_header(file_handle):
         header += field
     file_handle.write(header + '\n')
     
-def print_csv(cert_record, file_handle):
+# Build the pipe-delimited line for a single certificate record
+def format_csv(cert_record):
     output = ''
     first = True
     for field_name in field_names:
@@ -177,40 +479,832 @@ def print_csv(cert_record, file_handle):
             output += '|'
         if field_name in cert_record:
             output += str(cert_record[field_name])
-    file_handle.write(output + '\n')
-            
-if len(sys.argv) < 2:
-    print('ERROR: no file specified\n')
-    sys.exit(1)
-
-scan_date = sys.argv[1].replace('./', '').replace('_certs', '')
-cert_file = open(sys.argv[1], 'r')
-output_file = open('./output/' + sys.argv[1] + '.csv', 'w')
-print_header(output_file)
-for line in cert_file:
+    return output + '\n'
+
+def print_csv(cert_record, file_handle):
+    file_handle.write(format_csv(cert_record))
+
+# Decode a single 'sha1,base64 DER' line from the Sonar file into a certificate record, or None if
+#   the line is too broken to get the certificate out of
+def convert_line(line, scan_date):
     fields = line.split(',')
 
-    cert_der = base64.b64decode(fields[1].strip())
     try:
-        p = subprocess.Popen(['openssl', 'x509', '-inform', 'der', '-text', '-noout'],
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE)
-        cert_decode = p.communicate(input=cert_der)[0]
-        cert_dict = openssl_output_to_dict(cert_decode)
-        cert_dict['sha1'] = fields[0]
-        # We initially always indicate the feed match is False, as it's easier to update the 
-        #   value via SQL once it's in the database.  See the query in 'update_feed_match.sql'
-        cert_dict['feed_match'] = False
-        cert_dict['size'] = len(cert_der)
-        cert_dict['date'] = scan_date
-        if 'enc_issuer' in cert_dict and 'enc_subject' in cert_dict:
-            cert_dict['self_signed'] = cert_dict['enc_issuer'] == cert_dict['enc_subject']
+        with batch_metrics.timer('base64_decode'):
+            cert_der = base64.b64decode(fields[1].strip())
+    except (ValueError, IndexError):
+        # Truncated lines and bad base64, which show up now and then in the scan files
+        batch_metrics.count('lines_malformed')
+        return None
+    with batch_metrics.timer('cert_decode'):
+        try:
+            cert_dict = decode_cert(cert_der)
+        except Exception:
+            # A certificate that trips up the decoder is written out like one openssl can't read
+            cert_dict = {}
+    if len(cert_dict) == 0:
+        batch_metrics.count('certs_failed')
+    else:
+        batch_metrics.count('certs_decoded')
+    # These still get written, but they're worth knowing about when a new scan looks odd
+    for field in required_fields:
+        if field not in cert_dict:
+            batch_metrics.count('certs_missing_fields')
+            break
+    cert_dict['sha1'] = fields[0]
+    # This is only set to True here when feed files are given with --feeds.  Otherwise the value
+    #   gets updated via SQL once it's in the database.  See the query in 'update_feed_match.sql'
+    cert_dict['feed_match'] = False
+    cert_dict['size'] = len(cert_der)
+    cert_dict['date'] = scan_date
+    if 'enc_issuer' in cert_dict and 'enc_subject' in cert_dict:
+        cert_dict['self_signed'] = cert_dict['enc_issuer'] == cert_dict['enc_subject']
+    else:
+        cert_dict['self_signed'] = ''
+    if 'not_valid_before' in cert_dict and 'not_valid_after' in cert_dict:
+        cert_dict['duration'] = cert_dict['not_valid_after'] - cert_dict['not_valid_before']
+    return cert_dict
+
+# Records for certificates we've already decoded in a previous snapshot are kept in an SQLite
+#   database keyed by sha1.  Everything but the scan date is the same from week to week, so on a
+#   hit we can skip the base64 and certificate decoding entirely
+class ParseCache(object):
+    def __init__(self, path, scan_date):
+        self.scan_date = scan_date
+        self.hits = 0
+        self.lookups = 0
+        self.db_conn = sqlite3.connect(path)
+        # WAL mode lets the worker processes read from the cache while we write to it
+        self.db_conn.execute('PRAGMA journal_mode=WAL')
+        self.db_conn.execute('CREATE TABLE IF NOT EXISTS certs (sha1 TEXT PRIMARY KEY, '
+                             'record TEXT, last_seen TEXT)')
+        self.db_conn.execute('CREATE INDEX IF NOT EXISTS certs_last_seen ON certs (last_seen)')
+        self.db_conn.execute('CREATE TABLE IF NOT EXISTS snapshots (date TEXT PRIMARY KEY)')
+        self.db_conn.commit()
+
+    # Store newly decoded records and mark the ones we found as seen in this snapshot
+    def update(self, new_records, hit_sha1s):
+        self.hits += len(hit_sha1s)
+        self.lookups += len(hit_sha1s) + len(new_records)
+        self.db_conn.executemany('INSERT OR REPLACE INTO certs VALUES (?, ?, ?)',
+                                 [(sha1, record, self.scan_date) for sha1, record in new_records])
+        self.db_conn.executemany('UPDATE certs SET last_seen = ? WHERE sha1 = ?',
+                                 [(self.scan_date, sha1) for sha1 in hit_sha1s])
+        self.db_conn.commit()
+
+    # Forget any certificate that hasn't been seen in the last keep_snapshots snapshots
+    def evict(self, keep_snapshots):
+        self.db_conn.execute('INSERT OR IGNORE INTO snapshots VALUES (?)', (self.scan_date,))
+        cursor = self.db_conn.execute('SELECT date FROM snapshots ORDER BY date DESC LIMIT 1 '
+                                      'OFFSET ?', (keep_snapshots - 1,))
+        row = cursor.fetchone()
+        evicted = 0
+        if row != None:
+            evicted = self.db_conn.execute('DELETE FROM certs WHERE last_seen < ?', row).rowcount
+            self.db_conn.execute('DELETE FROM snapshots WHERE date < ?', row)
+        self.db_conn.commit()
+        return evicted
+
+    def close(self):
+        self.db_conn.close()
+
+# Each worker process keeps its own read-only connection to the cache
+cache_readers = {}
+
+def lookup_cached(cache_path, sha1s):
+    if cache_path not in cache_readers:
+        cache_readers[cache_path] = sqlite3.connect('file:' + cache_path + '?mode=ro', uri=True)
+    records = {}
+    # Stay under SQLite's limit on the number of query parameters
+    for start in range(0, len(sha1s), 500):
+        chunk = sha1s[start:start + 500]
+        query = 'SELECT sha1, record FROM certs WHERE sha1 IN (' + ','.join('?' * len(chunk)) + ')'
+        for sha1, record in cache_readers[cache_path].execute(query, chunk):
+            records[sha1] = record
+    return records
+
+# Each worker process also maps the index of every sha1 seen so far for itself
+delta_readers = {}
+
+def already_seen(index_path, sha1):
+    if index_path not in delta_readers:
+        delta_readers[index_path] = sha1_index.Sha1Index(index_path)
+    raw_sha1 = sha1_index.sha1_bytes(sha1.lower())
+    return raw_sha1 != None and raw_sha1 in delta_readers[index_path]
+
+# Options for the current run.  Worker processes get their copy through init_worker
+job_options = {}
+
+# Name cache totals as of the end of the last batch.  The caches live for the whole run while the
+#   metrics are per batch, so we only hand back how much the totals have moved
+last_cache_info = {}
+
+def init_worker(options):
+    global name_cache, name_string_cache
+    job_options.update(options)
+    cache_size = job_options.get('name_cache_size', name_cache_size)
+    name_cache = functools.lru_cache(maxsize=cache_size)(parse_name)
+    name_string_cache = functools.lru_cache(maxsize=cache_size)(name_to_openssl_string)
+    last_cache_info.clear()
+
+def count_cache_info(metric_name, cache):
+    info = cache.cache_info()
+    last_hits, last_misses = last_cache_info.get(metric_name, (0, 0))
+    batch_metrics.count(metric_name + '_hits', info.hits - last_hits)
+    batch_metrics.count(metric_name + '_misses', info.misses - last_misses)
+    last_cache_info[metric_name] = (info.hits, info.misses)
+
+# Database column name for a field, e.g. enc_subject_CN -> subject_cn
+def column_name(field_name):
+    return field_name.replace('enc_', '').lower()
+
+# Undo the escaping we do for the pipe-delimited output, which COPY would otherwise undo for us
+def unescape(value):
+    return re.sub(r'\\(.)', r'\1', value, flags=re.DOTALL)
+
+# Convert a field to the type of its Parquet column.  Missing text fields stay empty strings, the
+#   same as they load from the pipe-delimited files
+def parquet_value(field_name, value):
+    data_type = parquet_types.get(field_name, 'string')
+    if value == '' or value == None:
+        if data_type == 'string':
+            return ''
+        return None
+    if data_type == 'date':
+        try:
+            return datetime.datetime.strptime(value, '%Y%m%d').date()
+        except ValueError:
+            return None
+    elif data_type == 'int64':
+        # Some RSA exponents in scan data don't fit in a BIGINT column
+        if value >= 2 ** 63 or value < -2 ** 63:
+            return None
+    elif data_type == 'int32':
+        if value >= 2 ** 31 or value < -2 ** 31:
+            return None
+    elif data_type == 'string':
+        value = str(value)
+        if field_name.startswith('enc_'):
+            value = unescape(value)
+        elif field_name.endswith('_raw'):
+            value = value.strip('\'')
+    return value
+
+def parquet_schema():
+    arrow_types = { 'string': pyarrow.string(),
+                    'date': pyarrow.date32(),
+                    'timestamp': pyarrow.timestamp('s'),
+                    'int32': pyarrow.int32(),
+                    'int64': pyarrow.int64(),
+                    'bool': pyarrow.bool_() }
+    columns = []
+    for field_name in field_names:
+        data_type = parquet_types.get(field_name, 'string')
+        columns.append(pyarrow.field(column_name(field_name), arrow_types[data_type]))
+    return pyarrow.schema(columns)
+
+# Build an Arrow record batch with one typed column per cert_metadata column
+def format_parquet(cert_records):
+    schema = parquet_schema()
+    arrays = []
+    for field_name, column in zip(field_names, schema):
+        values = [parquet_value(field_name, record.get(field_name)) for record in cert_records]
+        arrays.append(pyarrow.array(values, type=column.type))
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+# Convert a batch of lines into what ends up in the output file, either pipe-delimited text or an
+#   Arrow record batch.  This is the unit of work handed to each worker process, so it has to be
+#   a module level function.  Along with the output we hand back any newly decoded records and
+#   the sha1s we found in the cache
+def convert_batch(lines):
+    batch_metrics.reset()
+    batch_metrics.count('certs_read', len(lines))
+    batch_metrics.count('bytes_in', sum([len(line) for line in lines]))
+    scan_date = job_options['scan_date']
+    cache_path = job_options.get('cache_path')
+    feed_sha1s = job_options.get('feed_sha1s', set())
+    # In delta mode only certificates that haven't been seen in any earlier snapshot are converted,
+    #   so one that goes away and comes back isn't loaded a second time
+    if job_options.get('seen_index'):
+        new_lines = []
+        for line in lines:
+            if already_seen(job_options['seen_index'], line.split(',', 1)[0]):
+                batch_metrics.count('certs_unchanged')
+            else:
+                new_lines.append(line)
+        lines = new_lines
+    cert_records = []
+    new_records = []
+    hit_sha1s = []
+    cached = {}
+    if cache_path:
+        cached = lookup_cached(cache_path, [line.split(',', 1)[0] for line in lines])
+    for line in lines:
+        sha1 = line.split(',', 1)[0]
+        if sha1 in cached:
+            cert_dict = json.loads(cached[sha1])
+            cert_dict['date'] = scan_date
+            hit_sha1s.append(sha1)
+        else:
+            cert_dict = convert_line(line, scan_date)
+            if cert_dict == None:
+                continue
+            if cache_path:
+                record = dict(cert_dict)
+                del record['date']
+                del record['feed_match']
+                new_records.append((sha1, json.dumps(record)))
+        cert_dict['feed_match'] = sha1.lower() in feed_sha1s
+        cert_records.append(cert_dict)
+    if job_options.get('column_stats'):
+        for record in cert_records:
+            for field in string_fields:
+                if field in record:
+                    batch_metrics.maximum('max_length_' + column_name(field),
+                                          len(str(record[field]).encode('utf-8')))
+    with batch_metrics.timer('format'):
+        if job_options.get('output_format') == 'parquet':
+            output = format_parquet(cert_records)
+        else:
+            output = ''.join([format_csv(record) for record in cert_records])
+    batch_metrics.count('cache_hits', len(hit_sha1s))
+    count_cache_info('name_cache', name_cache)
+    count_cache_info('name_string_cache', name_string_cache)
+    return (output, new_records, hit_sha1s, batch_metrics.snapshot())
+
+# Sonar publishes its certificate files gzipped, so read those as a stream rather than requiring
+#   them to be decompressed onto disk first.  The file is read as bytes so we always know the
+#   offset of the next line, which is what checkpoints and --range work in.  For gzipped files
+#   that's the offset in the decompressed data
+def open_input(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+# Wrap an output file opened in binary mode for writing text, compressed if asked.  Closing a gzip
+#   writer leaves the underlying file open, which is how checkpoints start a new gzip member
+def wrap_output(raw_file, compression):
+    if compression == 'gzip':
+        writer = gzip.GzipFile(fileobj=raw_file, mode='wb', compresslevel=6)
+        return io.TextIOWrapper(writer, encoding='utf-8')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd output requires the zstandard package')
+        writer = zstandard.ZstdCompressor().stream_writer(raw_file)
+        return io.TextIOWrapper(writer, encoding='utf-8')
+    return io.TextIOWrapper(raw_file, encoding='utf-8')
+
+# Splits the converted output across a number of files of roughly equal size.  Redshift loads files
+#   in parallel across its slices, so a handful of similar sized files loads much faster than one
+#   big one.  Each batch goes to whichever file has had the least written to it so far, which
+#   keeps the split deterministic for a given input
+#
+# Given the shard state from a checkpoint, each file is cut back to where it was at the checkpoint
+#   and appended to from there, so nothing written after the checkpoint ends up in the output twice
+class ShardedOutput(object):
+    def __init__(self, base_path, shards, compression, resume_shards=None):
+        self.compression = compression
+        if shards == 1:
+            self.paths = [base_path + self.extension()]
+        else:
+            self.paths = [base_path + '.%04d' % shard + self.extension() for shard in range(shards)]
+        self.files = []
+        self.raw_files = []
+        self.sizes = []
+        for shard in range(shards):
+            if resume_shards:
+                self.files.append(self.reopen_shard(self.paths[shard], resume_shards[shard]['bytes']))
+                self.sizes.append(resume_shards[shard]['written'])
+            else:
+                self.files.append(self.open_shard(self.paths[shard]))
+                self.sizes.append(0)
+
+    def extension(self):
+        return '.csv' + output_extensions[self.compression]
+
+    def open_shard(self, path):
+        raw_file = open(path, 'wb')
+        self.raw_files.append(raw_file)
+        output_file = wrap_output(raw_file, self.compression)
+        print_header(output_file)
+        return output_file
+
+    def reopen_shard(self, path, size):
+        os.truncate(path, size)
+        raw_file = open(path, 'ab')
+        self.raw_files.append(raw_file)
+        return wrap_output(raw_file, self.compression)
+
+    # Get everything written so far onto disk and return where each shard is up to.  Compressed
+    #   shards end their current gzip member or zstd frame so the file is complete at that point.
+    #   Both formats allow several of these one after another in a file
+    def checkpoint(self):
+        shard_state = []
+        for shard in range(len(self.files)):
+            self.files[shard].flush()
+            if self.compression == 'gzip':
+                self.files[shard].close()
+            elif self.compression == 'zstd':
+                self.files[shard].buffer.flush(zstandard.FLUSH_FRAME)
+            self.raw_files[shard].flush()
+            os.fsync(self.raw_files[shard].fileno())
+            shard_state.append({ 'path': self.paths[shard],
+                                 'bytes': self.raw_files[shard].tell(),
+                                 'written': self.sizes[shard] })
+            # The next member's header gets written straight away, so this has to come after the
+            #   size is taken
+            if self.compression == 'gzip':
+                self.files[shard] = wrap_output(self.raw_files[shard], self.compression)
+        return shard_state
+
+    def write(self, rows):
+        shard = self.sizes.index(min(self.sizes))
+        self.files[shard].write(rows)
+        self.sizes[shard] += len(rows)
+
+    def close(self):
+        for output_file in self.files:
+            output_file.close()
+        for raw_file in self.raw_files:
+            raw_file.close()
+
+    def bytes_written(self):
+        return sum([os.path.getsize(path) for path in self.paths])
+
+    # Write a COPY manifest listing every shard, assuming they get copied to s3_prefix as-is
+    def write_manifest(self, manifest_path, s3_prefix):
+        entries = []
+        for path in self.paths:
+            entries.append({ 'url': s3_prefix + os.path.basename(path),
+                             'mandatory': True,
+                             'meta': { 'content_length': os.path.getsize(path) } })
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump({ 'entries': entries }, manifest_file, indent=2)
+
+# The same thing for Parquet output.  Record batches are held until there are enough rows for a
+#   row group, since each batch written on its own would become its own tiny row group
+class ParquetShardedOutput(ShardedOutput):
+    def __init__(self, base_path, shards, compression, row_group_size):
+        if pyarrow is None:
+            raise RuntimeError('Parquet output requires the pyarrow package')
+        self.row_group_size = row_group_size
+        ShardedOutput.__init__(self, base_path, shards, compression)
+        self.pending = [[] for shard in range(shards)]
+        self.pending_rows = [0] * shards
+
+    def extension(self):
+        return '.parquet'
+
+    def open_shard(self, path):
+        return pyarrow.parquet.ParquetWriter(path, parquet_schema(),
+                                             compression=parquet_codecs[self.compression])
+
+    def write(self, record_batch):
+        shard = self.sizes.index(min(self.sizes))
+        self.pending[shard].append(record_batch)
+        self.pending_rows[shard] += record_batch.num_rows
+        self.sizes[shard] += record_batch.nbytes
+        if self.pending_rows[shard] >= self.row_group_size:
+            self.flush_shard(shard)
+
+    def flush_shard(self, shard):
+        if self.pending_rows[shard] > 0:
+            table = pyarrow.Table.from_batches(self.pending[shard])
+            self.files[shard].write_table(table, row_group_size=self.row_group_size)
+        self.pending[shard] = []
+        self.pending_rows[shard] = 0
+
+    def close(self):
+        for shard in range(len(self.files)):
+            self.flush_shard(shard)
+            self.files[shard].close()
+
+# Writes the output as a series of files of shard_rows rows each rather than a fixed number of
+#   them, so each one can be uploaded and loaded while the rest are still being converted.  As each
+#   file is finished its path is printed on stdout after shard_ready_prefix, which is what
+#   ingest_pipeline.py watches for.  With max_pending set, a new file isn't started until no more
+#   than that many finished ones are left on disk, so whatever is picking them up and deleting them
+#   holds back the conversion instead of letting it fill the disk
+shard_ready_prefix = 'Shard ready: '
+
+class RollingOutput(ShardedOutput):
+    def __init__(self, base_path, shard_rows, compression, max_pending=0):
+        self.base_path = base_path
+        self.shard_rows = shard_rows
+        self.compression = compression
+        self.max_pending = max_pending
+        self.paths = []
+        self.files = []
+        self.raw_files = []
+        self.sizes = []
+        self.rows = 0
+        self.finished_bytes = 0
+
+    def next_shard(self):
+        if self.max_pending > 0:
+            while len([path for path in self.paths if os.path.exists(path)]) > self.max_pending:
+                time.sleep(0.5)
+        path = self.base_path + '.part%04d' % len(self.paths) + self.extension()
+        self.paths.append(path)
+        self.files = [self.open_shard(path)]
+        self.sizes = [0]
+        self.rows = 0
+
+    def finish_shard(self):
+        self.files[0].close()
+        self.raw_files[-1].close()
+        self.finished_bytes += os.path.getsize(self.paths[-1])
+        self.files = []
+        announce_file(self.paths[-1])
+
+    # A batch that runs past the end of a file is split there, with the rest going to the next one
+    def write(self, rows):
+        while len(rows) > 0:
+            if len(self.files) == 0:
+                self.next_shard()
+            end = -1
+            for dummy in range(self.shard_rows - self.rows):
+                end = rows.find('\n', end + 1)
+                if end == -1:
+                    break
+            if end == -1:
+                shard_rows, rows = rows, ''
+            else:
+                shard_rows, rows = rows[:end + 1], rows[end + 1:]
+            self.files[0].write(shard_rows)
+            self.sizes[0] += len(shard_rows)
+            self.rows += shard_rows.count('\n')
+            if self.rows >= self.shard_rows:
+                self.finish_shard()
+
+    def close(self):
+        if len(self.files) > 0:
+            self.finish_shard()
+
+    # Finished files may have been loaded and removed by now
+    def bytes_written(self):
+        return self.finished_bytes
+
+def announce_file(path):
+    sys.stdout.write(shard_ready_prefix + path + '\n')
+    sys.stdout.flush()
+
+# Yield batches of lines along with the input offset just past the end of each batch.  Reading
+#   starts at offset, which has to be the start of a line, and stops at the first line that starts
+#   at or after end
+def read_batches(cert_file, batch_size, offset=0, end=None):
+    cert_file.seek(offset)
+    batch = []
+    for line in cert_file:
+        if end != None and offset >= end:
+            break
+        offset += len(line)
+        batch.append(line.decode('utf-8', 'replace'))
+        if len(batch) >= batch_size:
+            yield (offset, batch)
+            batch = []
+    if len(batch) > 0:
+        yield (offset, batch)
+
+# The offset of the first line that starts at or after the given offset.  A --range slice owns the
+#   lines that start inside it, so neighbouring slices never both convert the same line
+def line_start(cert_file, offset):
+    if offset == 0:
+        return 0
+    cert_file.seek(offset - 1)
+    return offset - 1 + len(cert_file.readline())
+
+# Parse --range start:end, where either end can be left off
+def parse_range(range_string, file_size):
+    fields = range_string.split(':')
+    if len(fields) != 2:
+        raise ValueError('expected start:end')
+    start = 0
+    end = file_size
+    if fields[0] != '':
+        start = int(fields[0])
+    if fields[1] != '':
+        end = min(int(fields[1]), file_size)
+    if start < 0 or start > end:
+        raise ValueError('start must be between 0 and end')
+    return start, end
+
+# Pass batches through unchanged, adding the sha1 of every line to sorter for the new delta index
+def track_sha1s(batches, sorter):
+    for offset, batch in batches:
+        for line in batch:
+            raw_sha1 = sha1_index.sha1_bytes(line.split(',', 1)[0].lower())
+            if raw_sha1 != None:
+                sorter.add(raw_sha1)
+        yield (offset, batch)
+
+# Write the index of this snapshot's sha1s for the next delta run, along with the sha1s of the
+#   certificates that have gone since the previous one and the date they were last seen.  The
+#   index of every sha1 ever seen is brought up to date as well, and the certificates that are
+#   back after being gone are written to returned_path with today's date, so their cert_last_seen
+#   rows can be cleared
+def finish_delta(index_path, seen_path, scan_date, sorter, previous, seen, gone_path,
+                 returned_path):
+    gone_file = None
+    on_gone = None
+    gone = [0]
+    if previous != None:
+        gone_file = open(gone_path, 'w')
+        gone_file.write('sha1|last_seen\n')
+        def on_gone(sha1):
+            gone_file.write(sha1.hex() + '|' + previous.scan_date + '\n')
+            gone[0] += 1
+    try:
+        total = sha1_index.write_index(index_path, scan_date, sorter.sorted(), previous, on_gone)
+    finally:
+        if gone_file != None:
+            gone_file.close()
+        sorter.cleanup()
+    current = sha1_index.Sha1Index(index_path)
+    returned = 0
+    try:
+        if previous != None:
+            with open(returned_path, 'w') as returned_file:
+                returned_file.write('sha1|returned\n')
+                for sha1 in current:
+                    if sha1 not in previous and seen != None and sha1 in seen:
+                        returned_file.write(sha1.hex() + '|' + scan_date + '\n')
+                        returned += 1
+        sha1_index.write_index(seen_path, scan_date, sha1_index.merge_sorted(seen or [], current))
+    finally:
+        current.close()
+    return total, gone[0], returned
+
+# Merge the longest value seen in each column into the stats file, so it covers every snapshot
+#   converted with it.  Values are measured as written, before COPY removes any escaping
+def update_column_stats(stats_path, maxima):
+    stats = {}
+    if os.path.exists(stats_path):
+        with open(stats_path, 'r') as stats_file:
+            stats = json.load(stats_file)
+    for name in maxima:
+        if name.startswith('max_length_'):
+            column = name[len('max_length_'):]
+            stats[column] = max(stats.get(column, 0), maxima[name])
+    ingest_metrics.write_atomically(stats_path, json.dumps(stats, indent=2, sort_keys=True) + '\n')
+
+# Checkpoints are written next to the output, replacing the last one in a single rename so a crash
+#   part way through writing one never leaves us without a usable checkpoint
+def write_checkpoint(checkpoint_path, state):
+    ingest_metrics.write_atomically(checkpoint_path, json.dumps(state, indent=2, sort_keys=True) + '\n')
+
+def read_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as checkpoint_file:
+        return json.load(checkpoint_file)
+
+# Hand batches out to a pool of worker processes and hand back the results in the order they were
+#   read, so the output is identical to a single process run.  Only a few batches per worker are
+#   in flight at once so we never read much further ahead of the output than we need to
+def convert_parallel(batches, workers, options):
+    pool = multiprocessing.Pool(workers, init_worker, (options,))
+    pending = collections.deque()
+    try:
+        for offset, batch in batches:
+            pending.append((offset, pool.apply_async(convert_batch, (batch,))))
+            if len(pending) >= workers * 4:
+                offset, result = pending.popleft()
+                yield (offset, result.get())
+        while len(pending) > 0:
+            offset, result = pending.popleft()
+            yield (offset, result.get())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a Project Sonar certificate file into '
+                                                 'pipe-delimited metadata for Redshift')
+    parser.add_argument('cert_file', help='Project Sonar certificate file, optionally gzipped')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to decode certificates with (default: 1)')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='lines handed to a worker at a time (default: 1000)')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help='write pipe-delimited text or typed Parquet columns (default: csv)')
+    parser.add_argument('--row-group-size', type=int, default=100000,
+                        help='rows per Parquet row group (default: 100000)')
+    parser.add_argument('--compress', choices=sorted(output_extensions), default='none',
+                        help='compress the output file so it can be COPYed with GZIP or ZSTD. '
+                             'For Parquet this picks the codec, and none means Snappy')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='split the output into this many similar sized files and write a '
+                             'COPY manifest for them, ideally a multiple of the cluster\'s slices')
+    parser.add_argument('--shard-rows', type=int, default=0, metavar='ROWS',
+                        help='write the csv output as a series of files of this many rows, '
+                             'printing each one\'s path as soon as it\'s finished so it can be '
+                             'loaded while the rest are converted.  Used by ingest_pipeline.py')
+    parser.add_argument('--max-pending-shards', type=int, default=0, metavar='N',
+                        help='with --shard-rows, wait for finished files to be removed before '
+                             'starting another once there are this many (default: no limit)')
+    parser.add_argument('--s3-prefix',
+                        help='where the shards will be copied to, used for the manifest '
+                             '(default: the S3_BUCKET_NAME bucket in settings.ini)')
+    parser.add_argument('--feeds', nargs='+', metavar='FILE',
+                        help='set feed_match for certificates in these blacklist feed CSV files, '
+                             'so the update_feed_match.sql UPDATE isn\'t needed after loading')
+    parser.add_argument('--cache',
+                        help='SQLite file of previously decoded certificates, keyed by sha1')
+    parser.add_argument('--cache-snapshots', type=int, default=4,
+                        help='drop cached certificates not seen in this many snapshots '
+                             '(default: 4)')
+    parser.add_argument('--name-cache-size', type=int, default=name_cache_size,
+                        help='issuer and subject names to keep parsed, per worker (default: ' +
+                             str(name_cache_size) + ')')
+    parser.add_argument('--intern-names', action='store_true',
+                        help='intern parsed name strings, which saves memory when the same '
+                             'names are held many times over')
+    parser.add_argument('--range', metavar='START:END',
+                        help='only convert the lines starting in this byte range of an '
+                             'uncompressed input file, so one file can be split across machines')
+    parser.add_argument('--checkpoint-interval', type=float, default=300, metavar='SECONDS',
+                        help='save how far the csv output has got this often, 0 for never '
+                             '(default: 300)')
+    parser.add_argument('--resume', action='store_true',
+                        help='carry on from the last checkpoint of an interrupted run')
+    parser.add_argument('--delta-index', metavar='PATH',
+                        help='sorted sha1 index of the previous snapshot.  Only certificates that '
+                             'haven\'t been seen before are written out, the sha1s of ones that '
+                             'have gone are written to a .gone file and ones that are back to a '
+                             '.returned file, and the index is updated to this '
+                             'snapshot')
+    parser.add_argument('--column-stats', metavar='FILE',
+                        help='record the longest value written to each text column in this JSON '
+                             'file, for sizing the columns with redshift_load.py --schema optimized')
+    parser.add_argument('--progress', type=float, default=30, metavar='SECONDS',
+                        help='print a progress line to stderr this often, 0 for none (default: 30)')
+    ingest_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    s3_prefix = args.s3_prefix
+    if args.shards > 1 and not s3_prefix:
+        settings = configparser.RawConfigParser()
+        settings.read('settings.ini')
+        if settings.has_option('S3', 'S3_BUCKET_NAME') and settings.get('S3', 'S3_BUCKET_NAME'):
+            s3_prefix = 's3://' + settings.get('S3', 'S3_BUCKET_NAME') + '/'
+        else:
+            parser.error('--shards needs --s3-prefix or S3_BUCKET_NAME in settings.ini')
+    if s3_prefix and not s3_prefix.endswith('/'):
+        s3_prefix += '/'
+
+    cert_name = args.cert_file
+    if cert_name.endswith('.gz'):
+        cert_name = cert_name[:-3]
+    scan_date = cert_name.replace('./', '').replace('_certs', '')
+    if args.resume and args.format == 'parquet':
+        parser.error('--resume only works with csv output')
+    # Finished files may already be loaded and gone by the time a run is resumed
+    if args.shard_rows > 0 and (args.format == 'parquet' or args.shards > 1 or args.resume):
+        parser.error('--shard-rows only works with csv output and can\'t be used with --shards '
+                     'or --resume')
+    # The index and the gone certificates are worked out over the whole snapshot
+    if args.delta_index and args.range:
+        parser.error('--delta-index can\'t be used with --range')
+    previous = None
+    if args.delta_index and os.path.exists(args.delta_index):
+        previous = sha1_index.Sha1Index(args.delta_index)
+        if previous.scan_date == scan_date:
+            parser.error(args.delta_index + ' is already up to date with this snapshot')
+    cert_file = open_input(args.cert_file)
+    output_base = './output/' + cert_name
+    offset = 0
+    end = None
+    if args.range:
+        # Finding a place in a gzip file means decompressing everything before it
+        if args.cert_file.endswith('.gz'):
+            parser.error('--range needs an uncompressed input file')
+        try:
+            offset, end = parse_range(args.range, os.path.getsize(args.cert_file))
+        except ValueError as e:
+            parser.error('--range ' + args.range + ': ' + str(e))
+        output_base += '.' + str(offset) + '-' + str(end)
+        offset = line_start(cert_file, offset)
+    checkpoint_path = output_base + '.checkpoint'
+    checkpointing = args.format == 'csv' and args.checkpoint_interval > 0 and args.shard_rows == 0
+    resume_shards = None
+    resume_offset = 0
+    resume_maxima = {}
+    if args.resume:
+        checkpoint = read_checkpoint(checkpoint_path)
+        if checkpoint == None:
+            print('No checkpoint found at ' + checkpoint_path + ', starting from the beginning')
+        elif checkpoint['compress'] != args.compress or len(checkpoint['shards']) != args.shards:
+            parser.error('--resume needs the same --compress and --shards as the interrupted run')
         else:
-            cert_dict['self_signed'] = ''
-        if 'not_valid_before' in cert_dict and 'not_valid_after' in cert_dict:
-            cert_dict['duration'] = cert_dict['not_valid_after'] - cert_dict['not_valid_before']
-        print_csv(cert_dict, output_file)
-    except subprocess.CalledProcessError:
-        pass
-output_file.close()
-cert_file.close()
+            offset = checkpoint['offset']
+            resume_offset = offset
+            resume_shards = checkpoint['shards']
+            # The longest values seen before the checkpoint, for --column-stats
+            resume_maxima = checkpoint.get('maxima', {})
+            print('Resuming from input offset ' + str(offset))
+    if args.shard_rows > 0:
+        output = RollingOutput(output_base, args.shard_rows, args.compress, args.max_pending_shards)
+    elif args.format == 'parquet':
+        output = ParquetShardedOutput(output_base, args.shards, args.compress, args.row_group_size)
+    else:
+        output = ShardedOutput(output_base, args.shards, args.compress, resume_shards)
+    cache = None
+    if args.cache:
+        cache = ParseCache(args.cache, scan_date)
+    options = { 'scan_date': scan_date,
+                'cache_path': args.cache,
+                'output_format': args.format,
+                'name_cache_size': args.name_cache_size,
+                'intern_names': args.intern_names,
+                'column_stats': args.column_stats != None,
+                'feed_sha1s': set() }
+    # The feeds are a few thousand sha1s at most, so a plain set is all we need
+    if args.feeds:
+        options['feed_sha1s'] = cert_feeds.read_feed_sha1s(args.feeds)
+    sorter = None
+    seen = None
+    if args.delta_index:
+        # Every sha1 from every earlier snapshot.  Indexes from before this was kept only have the
+        #   previous snapshot to go on
+        seen_path = args.delta_index + '.seen'
+        seen = previous
+        if os.path.exists(seen_path):
+            seen = sha1_index.Sha1Index(seen_path)
+        if seen != None:
+            options['seen_index'] = seen.path
+        sorter = sha1_index.Sha1Sorter(args.delta_index)
+        # The sha1s from before a checkpoint we're resuming from still belong in the new index
+        for dummy in track_sha1s(read_batches(cert_file, args.batch_size, 0, resume_offset), sorter):
+            pass
+    batches = read_batches(cert_file, args.batch_size, offset, end)
+    if sorter != None:
+        batches = track_sha1s(batches, sorter)
+    if args.workers > 1:
+        results = convert_parallel(batches, args.workers, options)
+    else:
+        init_worker(options)
+        results = ((offset, convert_batch(batch)) for offset, batch in batches)
+    run_metrics = ingest_metrics.Metrics('split_certs')
+    for name in resume_maxima:
+        run_metrics.maximum(name, resume_maxima[name])
+    last_checkpoint = time.time()
+    for offset, (rows, new_records, hit_sha1s, snapshot) in results:
+        run_metrics.merge(snapshot)
+        with run_metrics.timer('write'):
+            output.write(rows)
+        if cache != None:
+            with run_metrics.timer('cache_update'):
+                cache.update(new_records, hit_sha1s)
+        if checkpointing and time.time() - last_checkpoint >= args.checkpoint_interval:
+            with run_metrics.timer('checkpoint'):
+                write_checkpoint(checkpoint_path, { 'input': args.cert_file,
+                                                    'offset': offset,
+                                                    'compress': args.compress,
+                                                    'shards': output.checkpoint(),
+                                                    'maxima': run_metrics.maxima })
+            run_metrics.count('checkpoints')
+            last_checkpoint = time.time()
+        run_metrics.progress(args.progress, 'certs_read')
+    output.close()
+    cert_file.close()
+    run_metrics.count('bytes_out', output.bytes_written())
+    if args.column_stats:
+        update_column_stats(args.column_stats, run_metrics.maxima)
+    if sorter != None:
+        with run_metrics.timer('delta_index'):
+            total, gone, returned = finish_delta(args.delta_index, seen_path, scan_date, sorter,
+                                                 previous, seen, output_base + '.gone',
+                                                 output_base + '.returned')
+        run_metrics.count('certs_gone', gone)
+        run_metrics.count('certs_returned', returned)
+        summary = 'Delta index: ' + str(total) + ' certificates'
+        if previous != None:
+            summary += ', ' + str(gone) + ' gone and ' + str(returned) + ' back since '
+            summary += previous.scan_date
+            previous.close()
+        if seen != None and seen != previous:
+            seen.close()
+        print(summary)
+        if args.shard_rows > 0 and previous != None:
+            announce_file(output_base + '.gone')
+            announce_file(output_base + '.returned')
+    if cache != None:
+        evicted = cache.evict(args.cache_snapshots)
+        hit_rate = 0.0
+        if cache.lookups > 0:
+            hit_rate = 100.0 * cache.hits / cache.lookups
+        print('Cache hits: ' + str(cache.hits) + ' of ' + str(cache.lookups) +
+              ' (' + ('%.1f' % hit_rate) + '%), ' + str(evicted) + ' evicted')
+        cache.close()
+    if args.shards > 1:
+        output.write_manifest(output_base + '.manifest', s3_prefix)
+    # The run is complete, so there's nothing left to resume
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    run_metrics.summary('certs_read')
+    run_metrics.write_outputs(args.metrics_json, args.metrics_prom)
+
+if __name__ == '__main__':
+    main()
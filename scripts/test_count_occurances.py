@@ -0,0 +1,140 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# Check that count_occurances.py still prints the same report as the original one-query-per-value
+#   version, using a few fixture rows loaded into a local PostgreSQL server.  Point
+#   TEST_POSTGRES_DSN at the server, e.g. 'host=/tmp/pgdata dbname=postgres user=postgres', or set
+#   the usual PGHOST/PGUSER variables.  The test is skipped when no server can be reached
+import contextlib
+import count_occurances
+import io
+import os
+import psycopg2
+import unittest
+
+# feed_match and the subject fields in count_occurances.field_names order.  An empty field is NULL.
+#   The blacklisted rows have every field filled in, since the original report can't cope with
+#   NULLs among them
+fixture_rows = """t|US|a.example|Dallas|Evil Corp|IT|TX|x@evil|u1|s1
+t|US|b.example|Dallas|Evil Corp|IT|TX|y@evil|u2|s2
+t|US|c.example|Austin|Evil Corp|Ops|TX|x@evil|u1|s3
+t|US|d.example|Austin|Evil Corp|Ops|CA|z@evil|u3|s4
+t|RU|e.example|Moscow|Bad LLC|Ops|MOW|z@evil|u3|s5
+t|RU|f.example|Moscow|Bad LLC|Sales|MOW|w@bad|u4|s6
+f|US|a.example|Dallas|Evil Corp|||||
+f|US||Austin|Good Inc|IT|TX|||
+f|US||Seattle|Good Inc|IT|WA|||
+f|DE||Berlin|Good GmbH|||||
+f|US||Dallas|Evil Corp|Ops|TX|||
+f|RU||Moscow|Good OOO||MOW|||
+f|US||Austin|Good Inc|IT|TX|||
+f|US||Dallas|Good Inc|Ops|TX|||
+"""
+
+table = 'count_fixture'
+
+# The report as the original script worked it out, one query per field and per value
+def baseline_report(db_conn):
+    cursor = db_conn.cursor()
+    cursor.execute('SELECT COUNT(*) from ' + table + ' WHERE feed_match = True')
+    bad_samples = cursor.fetchone()[0]
+    cursor.execute('SELECT COUNT(*) from ' + table)
+    total_samples = cursor.fetchone()[0]
+    count_occurances.print_ratio(bad_samples, total_samples)
+
+    field_counts = {}
+    for field in count_occurances.field_names:
+        query = 'SELECT ' + field + ', COUNT(*) FROM ' + table + ' WHERE feed_match = True'
+        query += ' GROUP BY ' + field + ' ORDER BY COUNT(*) DESC'
+        cursor.execute(query)
+        field_counts[field] = [(row[0], row[1]) for row in cursor.fetchall() if row[1] > 1]
+
+    interesting_values = {}
+    for field in field_counts:
+        interesting_values[field] = []
+        for value in field_counts[field]:
+            query = 'SELECT COUNT(*) FROM ' + table + ' WHERE ' + field + ' = %s'
+            cursor.execute(query, (value[0],))
+            total = cursor.fetchone()[0]
+            if total > value[1]:
+                ratio = float(total) / value[1]
+                if ratio > 1.5:
+                    print(field + ': ' + value[0] + '     ' + str(value[1]) + ' -> ' + str(total) +
+                          ' (' + str(ratio) + ')')
+                    interesting_values[field].append(value)
+
+    field_list_string = ', '.join(count_occurances.field_names)
+    for field in interesting_values:
+        for value in interesting_values[field]:
+            query = 'SELECT ' + field_list_string + ' FROM ' + table + ' WHERE '
+            query += field + ' = %s and feed_match = True'
+            cursor.execute(query, (value[0],))
+            values = {}
+            for row in cursor.fetchall():
+                for column_num in range(len(count_occurances.field_names)):
+                    column_name = count_occurances.field_names[column_num]
+                    if column_name not in values:
+                        values[column_name] = {}
+                    if row[column_num] not in values[column_name]:
+                        values[column_name][row[column_num]] = 1
+                    else:
+                        values[column_name][row[column_num]] += 1
+            for column in values:
+                for entry in values[column]:
+                    if field != column and values[column][entry] > 1:
+                        count_occurances.print_cooccurrence(field, value[0], column, entry,
+                                                            values[column][entry])
+    cursor.close()
+
+def current_report(db_conn):
+    bad_samples, total_samples = count_occurances.count_samples(db_conn, table)
+    count_occurances.print_ratio(bad_samples, total_samples)
+    bad_rows = count_occurances.fetch_bad_rows(db_conn, table)
+    field_counts = count_occurances.count_bad_values(bad_rows)
+    totals = count_occurances.count_total_values(db_conn, field_counts, table)
+    interesting_values = count_occurances.report_interesting(field_counts, totals)
+    count_occurances.report_cooccurrences(bad_rows, interesting_values)
+
+def captured_output(report, db_conn):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        report(db_conn)
+    return output.getvalue().splitlines()
+
+# Values with the same count can come back from the database in either order, so only the three
+#   ratio lines are compared in place and the rest as a sorted list
+def normalised(lines):
+    return lines[:3] + sorted(lines[3:])
+
+class CountOccurancesTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            self.db_conn = psycopg2.connect(os.environ.get('TEST_POSTGRES_DSN', ''),
+                                            connect_timeout=5)
+        except psycopg2.OperationalError as e:
+            self.skipTest('no PostgreSQL server available: ' + str(e).strip())
+        columns = ['sha1 CHAR(40)', 'feed_match BOOLEAN']
+        columns += [field + ' VARCHAR(256)' for field in count_occurances.field_names]
+        cursor = self.db_conn.cursor()
+        cursor.execute('CREATE TEMP TABLE ' + table + ' (' + ', '.join(columns) + ')')
+        rows = ''
+        for row_num, row in enumerate(fixture_rows.splitlines()):
+            rows += '%040x' % row_num + '|' + row + '\n'
+        cursor.copy_expert('COPY ' + table + ' FROM STDIN WITH (FORMAT text, DELIMITER \'|\','
+                           ' NULL \'\')', io.StringIO(rows))
+        cursor.close()
+
+    def tearDown(self):
+        self.db_conn.rollback()
+        self.db_conn.close()
+
+    def test_matches_baseline(self):
+        baseline = captured_output(baseline_report, self.db_conn)
+        current = captured_output(current_report, self.db_conn)
+        self.assertEqual(normalised(current), normalised(baseline))
+        # Make sure the fixture actually exercises the interesting value and co-occurrence reports
+        self.assertIn('subject_c: US     4 -> 10 (2.5)', current)
+        self.assertIn('subject_st: TX + subject_o: Evil Corp  3', current)
+
+if __name__ == '__main__':
+    unittest.main()
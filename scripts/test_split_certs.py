@@ -0,0 +1,112 @@
+# Copyright (c) 2016, Atomic Mole LLC
+# All rights reserved.
+#
+# Check that split_certs_redshift.py's native decoder produces exactly the same record as parsing
+#   'openssl x509' output does, for the kinds of certificate where the two are most likely to drift
+#   apart.  The test is skipped when the cryptography package or the openssl binary is missing
+import datetime
+import shutil
+import split_certs_redshift
+import unittest
+import warnings
+
+try:
+    from cryptography import utils as cryptography_utils
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    from cryptography.x509.oid import NameOID
+except ImportError:
+    x509 = None
+
+def name(*attributes):
+    return x509.Name([x509.NameAttribute(oid, value) for oid, value in attributes])
+
+# The version field is always 'a0 03 02 01 02' for a v3 certificate, and the serial number's tag
+#   and length come straight after it
+version_field = b'\xa0\x03\x02\x01\x02'
+
+# The certificate builder won't take a negative serial number, so build the certificate with a
+#   positive one of the same encoded length and swap the serial's bytes in afterwards.  That
+#   breaks the signature, but neither decoder checks it
+def with_serial(cert_der, serial_number):
+    start = cert_der.index(version_field) + len(version_field)
+    length = cert_der[start + 1]
+    serial_bytes = serial_number.to_bytes(length, 'big', signed=True)
+    return cert_der[:start + 2] + serial_bytes + cert_der[start + 2 + length:]
+
+class DecoderParityTest(unittest.TestCase):
+    def setUp(self):
+        if x509 == None:
+            self.skipTest('the cryptography package isn\'t installed')
+        if shutil.which('openssl') == None:
+            self.skipTest('no openssl binary on the PATH')
+        self.signing_key = rsa.generate_private_key(65537, 2048, default_backend())
+        self.subject = name((NameOID.COUNTRY_NAME, 'US'),
+                            (NameOID.STATE_OR_PROVINCE_NAME, 'Texas'),
+                            (NameOID.ORGANIZATION_NAME, 'Example Corp'),
+                            (NameOID.COMMON_NAME, 'www.example.com'))
+
+    def build(self, subject=None, subject_key=None, serial_number=1234567):
+        if subject == None:
+            subject = self.subject
+        if subject_key == None:
+            subject_key = self.signing_key
+        not_before = datetime.datetime(2015, 6, 1, 12, 30, 0)
+        builder = x509.CertificateBuilder().subject_name(subject).issuer_name(self.subject)
+        builder = builder.public_key(subject_key.public_key()).serial_number(serial_number)
+        builder = builder.not_valid_before(not_before)
+        builder = builder.not_valid_after(not_before + datetime.timedelta(days=365))
+        cert = builder.sign(self.signing_key, hashes.SHA256(), default_backend())
+        return cert.public_bytes(serialization.Encoding.DER)
+
+    def assertParity(self, cert_der):
+        native = split_certs_redshift.der_to_dict(cert_der)
+        self.assertEqual(native, split_certs_redshift.openssl_decode(cert_der))
+        return native
+
+    def test_rsa(self):
+        record = self.assertParity(self.build())
+        self.assertEqual(record['key_type'], 'rsa')
+
+    def test_ec(self):
+        for curve in (ec.SECP256R1, ec.SECP384R1):
+            key = ec.generate_private_key(curve(), default_backend())
+            self.assertParity(self.build(subject_key=key))
+
+    def test_multi_valued_rdn(self):
+        subject = x509.Name([
+            x509.RelativeDistinguishedName([x509.NameAttribute(NameOID.COUNTRY_NAME, 'DE')]),
+            x509.RelativeDistinguishedName([
+                x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, 'IT'),
+                x509.NameAttribute(NameOID.COMMON_NAME, 'multi.example.com')])])
+        self.assertParity(self.build(subject))
+
+    def test_non_ascii(self):
+        subject = name((NameOID.COUNTRY_NAME, 'DE'),
+                       (NameOID.ORGANIZATION_NAME, 'Müller & Söhne GmbH'),
+                       (NameOID.COMMON_NAME, '例え.jp'),
+                       (NameOID.EMAIL_ADDRESS, 'admin@example.com'))
+        self.assertParity(self.build(subject))
+
+    # openssl prints serials that fit in a signed 64-bit integer differently to larger ones
+    def test_large_serials(self):
+        for serial_number in (1, 2 ** 63 - 1, 2 ** 63, 2 ** 64 + 1, 2 ** 158 + 12345):
+            self.assertParity(self.build(serial_number=serial_number))
+
+    def test_negative_serials(self):
+        with warnings.catch_warnings():
+            # cryptography warns about serials RFC 5280 doesn't allow, which scan data is full of
+            warnings.simplefilter('ignore', cryptography_utils.CryptographyDeprecationWarning)
+            for serial_number in (-5, -1, -2 ** 63, -2 ** 63 - 1, -2 ** 100):
+                # Start from a positive serial that encodes to the same number of bytes
+                length = ((-serial_number - 1).bit_length() + 8) // 8
+                cert_der = with_serial(self.build(serial_number=0x7f << (8 * (length - 1))),
+                                       serial_number)
+                cert = x509.load_der_x509_certificate(cert_der, default_backend())
+                self.assertEqual(cert.serial_number, serial_number)
+                self.assertParity(cert_der)
+
+if __name__ == '__main__':
+    unittest.main()